@@ -1,21 +1,32 @@
 import json
-import uuid
+import queue
 import shutil
 import logging
 import validators
 import service_util
 import service_types
 from pathlib import Path
-from flask import request
+from flask import request, Response, stream_with_context
 from datetime import datetime
 from service_util import remove_empty
 from werkzeug.utils import secure_filename
-from kesl_control import KESLControl
-from scan_manager import ScanManager
+from werkzeug.exceptions import RequestEntityTooLarge
+from spool import SpoolFile, SpoolManager, SpoolLimitExceeded
+from kesl_control import KESLControl, ScanTaskPool
+from scan_manager import ScanManager, SCANS_PAGE_SIZE
+from db_control import VERDICT_ORDER
+from image_store import ImageStore
+from registry_watch import RegistryWatcher
+from callback_dispatcher import CallbackDispatcher
+from scans_retention import ScansRetention
+from podman_control import PodmanStorage
 from configurator import service_config
 from make_error import CommonErrorResponse
 from certificates_storage import CertificatesStorage
 
+SCAN_STATUSES = ('created', 'queued', 'running', 'completed')
+SCANS_PAGE_LIMIT = 1000
+
 
 class Application(CommonErrorResponse):
 
@@ -29,10 +40,26 @@ class Application(CommonErrorResponse):
 
     def final_construct(self):
         Path(service_config['COMMON']['KRAS4D_TMPPATH']).mkdir(parents=True, exist_ok=True)
+        SpoolManager().final_construct()
+        # podman storage is used by restored scans as soon as scan manager is constructed
+        response, code = PodmanStorage().final_construct()
+        if code != 0:
+            self.log.error(f"unable to configure podman storage: code({code}), response({response})")
+        response, code = ImageStore().final_construct()
+        if code != 0:
+            self.log.error(f"unable to construct image cache: code({code}), response({response})")
+        # leaked tasks are removed and pool is ready before restored scans are started by scan manager
+        response, code = ScanTaskPool().final_construct()
+        if code != 0:
+            self.log.error(f"unable to construct scan task pool: code({code}), response({response})")
         database_path = str(Path(service_config['COMMON']['KRAS4D_SQLPATH']).absolute())
         response, code = self.scan_manager.final_construct(database_path)
         if code != 0:
             self.log.error(f"unable to construct av manager: ({code}), response({response})")
+        else:
+            response, code = RegistryWatcher().final_construct(self.scan_manager)
+            if code != 0:
+                self.log.error(f"unable to construct registry watcher: ({code}), response({response})")
         response, code = self.set_kesl_trace_level()
         if code != 0:
             self.log.error(f"unable to set kesl trace level: ({code}), response({response})")
@@ -66,6 +93,22 @@ class Application(CommonErrorResponse):
             if code != 0:
                 self.log.error(f'unable to revoke active key: {response}')
 
+    def service_info(self):
+        return {
+            'scan pool': self.scan_manager.scheduler.pool_info(),
+            'scan sessions': self.scan_manager.scan_sessions_map.cache_info(),
+            'spool': SpoolManager().spool_info(),
+            'podman storage': PodmanStorage().storage_info(),
+            'image cache': ImageStore().cache_info(),
+            'callbacks': CallbackDispatcher().dispatcher_info(),
+            'scans retention': ScansRetention().retention_info(),
+            'verdict cache': {
+                'files': self.scan_manager.file_cache.cache_info(),
+                'images': self.scan_manager.image_cache.cache_info(),
+                'layers': self.scan_manager.layer_cache.cache_info()
+            }
+        }
+
     @staticmethod
     def auth():
         if service_config['CONTROL']['KRAS4D_XAPIKEY']:
@@ -110,42 +153,73 @@ class Application(CommonErrorResponse):
             self.log.error(f"unable to activate KESL (code: {app_code}) with error: {response}")
             attempt += 1
 
+    @staticmethod
+    def spool_body(suffix=''):
+        # read WSGI input by fixed-size chunks straight into spool file, hash and count on the fly
+        max_size = int(service_config['COMMON']['KRAS4D_MAXBODYSIZE'] or 0)
+        if max_size and request.content_length and request.content_length > max_size:
+            raise SpoolLimitExceeded(f'request body exceeds {max_size} bytes')
+        spool_file = request.create_spool_file(suffix, request.content_length)
+        spool_file.copy_from(request.stream)
+        return spool_file.commit()
+
+    @staticmethod
+    def unique_item_name(name, items):
+        # parts with equal file names must not overwrite (and leak) each other
+        name = name or 'noname'
+        if name not in items:
+            return name
+        stem, suffix, number = Path(name).stem, Path(name).suffix, 1
+        while f'{stem}_{number}{suffix}' in items:
+            number += 1
+        return f'{stem}_{number}{suffix}'
+
+    @staticmethod
+    def spool_part(stream):
+        # multipart parts are already spooled by SpoolRequest while the form is parsed
+        if isinstance(stream.stream, SpoolFile):
+            return stream.stream.commit()
+        spool_file = request.create_spool_file()
+        spool_file.copy_from(stream.stream)
+        return spool_file.commit()
+
     def unpack_body(self, content_type):
         result, error_code = [], None
-        tmp_folder = Path(service_config['COMMON']['KRAS4D_TMPPATH'])
         self.log.debug(f'REQUEST: /ADDCERT POST from {request.remote_addr} content-type: ({content_type}')
         if content_type.startswith('application/octet-stream'):
-            name = f'{str(uuid.uuid4())}.crt'
-            path = str(tmp_folder.joinpath(name).absolute())
+            path = None
             try:
-                with open(path, 'wb+') as (stream):
-                    stream.write(request.get_data())
-            except (OSError, ValueError, Exception) as ex:
+                path, _, _ = self.spool_body('.crt')
+            except (OSError, ValueError, RequestEntityTooLarge, Exception) as ex:
                 error_code = str(ex)
+                request.discard_spool_files()
                 self.log.error(f"unable to create file from octet-stream: {error_code}", exc_info=True)
             result.append({
                 'path': path,
-                'name': name,
+                'name': Path(path).name if path else None,
                 'code': error_code
             })
         elif content_type.startswith('multipart/form-data'):
-            if request.files:
+            try:
                 stream_dict = request.files.to_dict(flat=False)
-                for key in stream_dict:
-                    for stream in stream_dict[key]:
-                        error_code = None
-                        path = str(tmp_folder.joinpath(str(uuid.uuid4())).absolute())
-                        name = secure_filename(stream.filename) if stream.filename else 'noname'
-                        try:
-                            stream.save(path)
-                        except (OSError, ValueError, Exception) as ex:
-                            error_code = str(ex)
-                            self.log.error(f"unable to create file from multipart: {error_code}", exc_info=True)
-                        result.append({
-                            'path': path,
-                            'name': name,
-                            'code': error_code
-                        })
+            except (ValueError, RequestEntityTooLarge) as ex:
+                request.discard_spool_files()
+                self.log.error(f"unable to parse multipart: {str(ex)}", exc_info=True)
+                return [{'path': None, 'name': None, 'code': str(ex)}]
+            for key in stream_dict:
+                for stream in stream_dict[key]:
+                    error_code, path = None, None
+                    name = secure_filename(stream.filename) if stream.filename else 'noname'
+                    try:
+                        path, _, _ = self.spool_part(stream)
+                    except (OSError, ValueError, Exception) as ex:
+                        error_code = str(ex)
+                        self.log.error(f"unable to create file from multipart: {error_code}", exc_info=True)
+                    result.append({
+                        'path': path,
+                        'name': name,
+                        'code': error_code
+                    })
         return result
 
     def add_certificate(self, content_type):
@@ -160,6 +234,7 @@ class Application(CommonErrorResponse):
                 try:
                     # ca_err = None
                     shutil.move(Path(item['path']), cert_path)
+                    SpoolManager().forget(item['path'])
                     hash_name, ca_err = self.cert_storage.add_cert(cert_path)
                     if ca_err == 0:
                         hash_name, ca_err = self.cert_storage.update_ca()
@@ -169,11 +244,32 @@ class Application(CommonErrorResponse):
         return json.dumps(objects, indent=4), 200
 
     def show_all(self):
-        self.log.debug(f'REQUEST: /SCANS GET from {request.remote_addr} force:%s', ('force' in request.args))
+        self.log.debug(f'REQUEST: /SCANS GET from {request.remote_addr} args:%s', dict(request.args))
         if not self.auth():
             self.log.error(f'REQUEST NOT AUTHORIZED')
             return self.make_error(self.ERR_FORBIDDEN)
-        return self.scan_manager.show_all(('force' in request.args)), 200
+        try:
+            filters, limit = self.scans_filters(request.args)
+            response, code = self.scan_manager.show_all(filters, request.args.get('cursor'), limit,
+                                                        'force' in request.args)
+        except ValueError as ex:
+            return self.make_error(self.ERR_INVALID_PARAMETER, str(ex))
+        return (response, 200) if code == 0 else self.make_error(self.ERR_INTERNAL_SERVER_ERROR, response)
+
+    @staticmethod
+    def scans_filters(args):
+        filters = {'status': args.get('status'), 'verdict': args.get('verdict')}
+        if filters['status'] is not None and filters['status'] not in SCAN_STATUSES:
+            raise ValueError(f'unknown status {filters["status"]}, expected one of {", ".join(SCAN_STATUSES)}')
+        if filters['verdict'] is not None and filters['verdict'] not in VERDICT_ORDER:
+            raise ValueError(f'unknown verdict {filters["verdict"]}, expected one of {", ".join(VERDICT_ORDER)}')
+        # dates are compared as epoch seconds, date without offset is local time
+        for key in ('created_after', 'created_before'):
+            filters[key] = datetime.fromisoformat(args[key]).timestamp() if args.get(key) else None
+        limit = int(args.get('limit', SCANS_PAGE_SIZE))
+        if not 0 < limit <= SCANS_PAGE_LIMIT:
+            raise ValueError(f'limit must be in range 1..{SCANS_PAGE_LIMIT}')
+        return filters, limit
 
     def show_scan_id(self, guid):
         if not self.auth():
@@ -181,27 +277,91 @@ class Application(CommonErrorResponse):
             return self.make_error(self.ERR_FORBIDDEN)
         self.log.debug(f'REQUEST: /SCANS/{guid} GET from {request.remote_addr} force:%s', ('force' in request.args))
         response, code = self.scan_manager.show_scan_id(guid, ('force' in request.args))
+        if code == 0 and 'wait_for' in request.args:
+            try:
+                timeout = min(float(request.args.get('timeout', service_config['COMMON']['KRAS4D_LONGPOLLTIMEOUT'])),
+                              float(service_config['COMMON']['KRAS4D_LONGPOLLTIMEOUT']))
+            except ValueError as ex:
+                return self.make_error(self.ERR_INVALID_PARAMETER, str(ex))
+            self.scan_manager.wait_scan_status(guid, request.args.get('wait_for'), timeout)
+            response, code = self.scan_manager.show_scan_id(guid, False)
         return (remove_empty(response), 200) if code == 0 else self.make_error(self.ERR_OBJECT_NOT_FOUND)
 
+    def show_watches(self, watch_id=None):
+        if not self.auth():
+            self.log.error(f'REQUEST NOT AUTHORIZED')
+            return self.make_error(self.ERR_FORBIDDEN)
+        self.log.debug(f'REQUEST: /WATCHES GET from {request.remote_addr}')
+        response, code = RegistryWatcher().show_watches(watch_id)
+        return (remove_empty(response) if watch_id else response, 200) if code == 0 \
+            else self.make_error(self.ERR_OBJECT_NOT_FOUND)
+
+    def add_watch(self):
+        if not self.auth():
+            self.log.error(f'REQUEST NOT AUTHORIZED')
+            return self.make_error(self.ERR_FORBIDDEN)
+        self.log.debug(f'REQUEST: /WATCHES POST from {request.remote_addr}')
+        try:
+            watch = json.loads(request.data)
+        except ValueError as ex:
+            return self.make_error(self.ERR_INVALID_JSON, str(ex))
+        response, code = RegistryWatcher().add_watch(watch)
+        if code != 0:
+            return self.make_error(self.ERR_INVALID_PARAMETER, response)
+        return {'id': response, 'location': '/watches/' + response}, 201
+
+    def delete_watch(self, watch_id):
+        if not self.auth():
+            self.log.error(f'REQUEST NOT AUTHORIZED')
+            return self.make_error(self.ERR_FORBIDDEN)
+        self.log.debug(f'REQUEST: /WATCHES/{watch_id} DELETE from {request.remote_addr}')
+        response, code = RegistryWatcher().delete_watch(watch_id)
+        return ({'id': response}, 200) if code == 0 else self.make_error(self.ERR_OBJECT_NOT_FOUND)
+
+    def scan_events(self, guid):
+        if not self.auth():
+            self.log.error(f'REQUEST NOT AUTHORIZED')
+            return self.make_error(self.ERR_FORBIDDEN)
+        self.log.debug(f'REQUEST: /SCANS/{guid}/EVENTS GET from {request.remote_addr}')
+        # subscribe before snapshot: changes between them are not lost
+        subscriber = self.scan_manager.events.subscribe(guid)
+        response, code = self.scan_manager.show_scan_id(guid, False)
+        if code != 0:
+            self.scan_manager.events.unsubscribe(guid, subscriber)
+            return self.make_error(self.ERR_OBJECT_NOT_FOUND)
+        keepalive = float(service_config['COMMON']['KRAS4D_SSEKEEPALIVE'])
+
+        def sse_message(event_type, data):
+            return f'event: {event_type}\ndata: {json.dumps(data, default=service_util.json_default_decode)}\n\n'
+
+        def generate():
+            try:
+                yield sse_message('summary', remove_empty(response))
+                if response['status'] == 'completed':
+                    return
+                while True:
+                    try:
+                        event_type, data = subscriber.get(timeout=keepalive)
+                    except queue.Empty:
+                        yield ': keep-alive\n\n'
+                        continue
+                    yield sse_message(event_type, data)
+                    if event_type == 'status' and data['status'] == 'completed':
+                        summary, _ = self.scan_manager.show_scan_id(guid, False)
+                        yield sse_message('summary', remove_empty(summary))
+                        return
+            finally:
+                self.scan_manager.events.unsubscribe(guid, subscriber)
+
+        return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
     @staticmethod
     def validate_url(scan_session):
         bad_data = []
         if not validators.url(scan_session['session_info']['source']):
             bad_data.append({'source': scan_session['session_info']['source']})
-        if service_util.key_exists(scan_session,
-                                   'scan_summary', 'scan_params', 'destination') and \
-                not validators.url(scan_session['scan_summary']['scan_params']['destination']):
-            bad_data.append({'destination': scan_session['scan_summary']['scan_params']['destination']})
-        if service_util.key_exists(scan_session,
-                                   'scan_summary', 'scan_params', 'custom_callbacks', 'on_detect', 'uri') and \
-                not validators.url(scan_session['scan_summary']['scan_params']['custom_callbacks']['on_detect']['uri']):
-            bad_data.append({'on detect uri':
-                            scan_session['scan_summary']['scan_params']['custom_callbacks']['on_detect']['uri']})
-        if service_util.key_exists(scan_session,
-                                   'scan_summary', 'scan_params', 'custom_callbacks', 'on_complete', 'uri') and \
-                not validators.url(scan_session['scan_summary']['scan_params']['custom_callbacks']['on_complete']['uri']):
-            bad_data.append({'on detect uri':
-                            scan_session['scan_summary']['scan_params']['custom_callbacks']['on_complete']['uri']})
+        bad_data.extend(service_util.validate_params_urls(scan_session['scan_summary']['scan_params']))
         return bad_data
 
     #
@@ -222,13 +382,17 @@ class Application(CommonErrorResponse):
                 'type'  : 'stream',
                 'source': 'application/octet-stream'
             })
-            path = str(Path(service_config['COMMON']['KRAS4D_TMPPATH']).joinpath(str(uuid.uuid4())).absolute())
             try:
-                with open(path, 'wb+') as (stream):
-                    stream.write(request.get_data())
+                path, sha256, _ = self.spool_body()
                 # scan_session['session_info']['items'].append({'noname': path})
                 scan_session['session_info']['items'].update({'noname': path})
+                scan_session['session_info']['hashes'].update({'noname': sha256})
+            except (SpoolLimitExceeded, RequestEntityTooLarge) as ex:
+                request.discard_spool_files()
+                self.log.error(f"octet-stream rejected: {str(ex)}")
+                return self.make_error(self.ERR_BODY_TOO_LARGE, str(ex))
             except (OSError, ValueError, Exception) as ex:
+                request.discard_spool_files()
                 self.log.error(f"unable to create file from octet-stream: {str(ex)}", exc_info=True)
                 return self.make_error(self.ERR_INTERNAL_SERVER_ERROR, str(ex))
         elif content_type.startswith('multipart/form-data'):
@@ -236,24 +400,28 @@ class Application(CommonErrorResponse):
                 'type'  : 'stream',
                 'source': 'multipart/form-data'
             })
-            if request.files:
-                try:
-                    stream_dict = request.files.to_dict(flat=False)
-                    for key in stream_dict:
-                        for stream in stream_dict[key]:
-                            path = str(Path(service_config['COMMON']['KRAS4D_TMPPATH'])
-                                       .joinpath(str(uuid.uuid4())).absolute())
-                            stream.save(path)
-                            scan_session['session_info']['items'].update({
-                                secure_filename(stream.filename) if stream.filename else 'noname': path
-                            })
-                except (OSError, ValueError, Exception) as ex:
-                    self.log.error(f"unable to create file from multipart/form-data: {str(ex)}", exc_info=True)
-                    return self.make_error(self.ERR_INTERNAL_SERVER_ERROR, str(ex))
+            try:
+                stream_dict = request.files.to_dict(flat=False)
+                for key in stream_dict:
+                    for stream in stream_dict[key]:
+                        path, sha256, _ = self.spool_part(stream)
+                        name = self.unique_item_name(secure_filename(stream.filename) if stream.filename else '',
+                                                     scan_session['session_info']['items'])
+                        scan_session['session_info']['items'].update({name: path})
+                        scan_session['session_info']['hashes'].update({name: sha256})
+            except (SpoolLimitExceeded, RequestEntityTooLarge) as ex:
+                request.discard_spool_files()
+                self.log.error(f"multipart/form-data rejected: {str(ex)}")
+                return self.make_error(self.ERR_BODY_TOO_LARGE, str(ex))
+            except (OSError, ValueError, Exception) as ex:
+                request.discard_spool_files()
+                self.log.error(f"unable to create file from multipart/form-data: {str(ex)}", exc_info=True)
+                return self.make_error(self.ERR_INTERNAL_SERVER_ERROR, str(ex))
             if 'params' in request.form:
                 try:
                     scan_session['scan_summary']['scan_params'] = json.loads(request.form['params'])
                 except (OSError, ValueError, Exception) as ex:
+                    request.discard_spool_files()
                     self.log.error(f"invalid json: {str(ex)}", exc_info=True)
                     return self.make_error(self.ERR_INVALID_JSON, str(ex))
         elif content_type.startswith('application/json'):
@@ -278,6 +446,7 @@ class Application(CommonErrorResponse):
                 return self.make_error(self.ERR_INVALID_URL_FORMAT, check_result)
         if (scan_session['session_info']['type'] == 'stream' and bool(scan_session['session_info']['items']) is False) \
                 or (scan_session['session_info']['type'] == 'image' and scan_session['session_info']['source'] is None):
+            request.discard_spool_files()
             return self.make_error(self.ERR_NOTHING_TO_PROCESS)
         guid = self.scan_manager.add_scan_request(scan_session)
         try:
@@ -0,0 +1,272 @@
+import json
+import time
+import uuid
+import socket
+import logging
+import requests
+import threading
+import service_util
+from string import Template
+from datetime import datetime
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from configurator import service_config
+from service_types import SpecSingleton
+
+CREATE_CALLBACKS_REQUEST = '''
+    CREATE TABLE IF NOT EXISTS callbacks(
+        callback_id  INTEGER PRIMARY KEY AUTOINCREMENT,
+        guid         TEXT,
+        name         TEXT,
+        uri          TEXT,
+        content_type TEXT,
+        body         TEXT,
+        state        TEXT,
+        attempts     INTEGER,
+        next_attempt REAL,
+        created      REAL,
+        delivered    REAL,
+        last_error   TEXT,
+        owner        TEXT,
+        claim        TEXT
+    );
+'''
+
+CREATE_CALLBACKS_INDEX_REQUESTS = (
+    'CREATE INDEX IF NOT EXISTS callbacks_due ON callbacks(state, next_attempt);',
+    'CREATE INDEX IF NOT EXISTS callbacks_guid ON callbacks(guid);',
+    'CREATE INDEX IF NOT EXISTS callbacks_claim ON callbacks(claim);'
+)
+
+CALLBACK_COLUMNS = ('callback_id', 'guid', 'name', 'uri', 'content_type', 'body', 'state', 'attempts',
+                    'next_attempt', 'created', 'delivered', 'last_error', 'owner', 'claim')
+
+
+def json_replace(json_data, subst_data):
+    result_data = {}
+    for key, value in json_data.items():
+        if isinstance(value, dict):
+            result_data[key] = json_replace(value, subst_data)
+        else:
+            result_data[key] = subst_data[value] \
+                if isinstance(value, str) and value.startswith('$') and value in subst_data else value
+    return result_data
+
+
+def render_callback(clbk, subst):
+    """
+    returns (content type, body text) of callback request, body is None if callback has no body
+    """
+    if 'body' not in clbk:
+        return 'application/json', None
+    if clbk.get('content-type') == 'text/plain':
+        text_subst = {key.lstrip('$'): json.dumps(value) for key, value in subst.items()}
+        return 'text/plain', Template(str(clbk['body'])).safe_substitute(text_subst)
+    if clbk.get('content-type') == 'application/json' and isinstance(clbk['body'], dict):
+        return 'application/json', json.dumps(json_replace(clbk['body'], subst))
+    return 'application/json', json.dumps(clbk['body'])
+
+
+class CallbackDispatcher(metaclass=SpecSingleton):
+    """
+    custom callbacks are stored in database and delivered by background workers with retries,
+    scan workers are never blocked by slow or dead callback receivers
+    """
+
+    RETRY_STATUSES  = (408, 425, 429, 500, 502, 503, 504)
+    MAX_BACKOFF     = 3600
+    POLL_PERIOD     = 5
+
+    def __init__(self):
+        self.log = logging.getLogger('main.callbacks')
+        self.storage = None
+        # services sharing database volume claim callbacks by node name
+        self.node_name = socket.gethostname()
+        self.workers_count = max(1, int(service_config['CONTROL']['KRAS4D_CALLBACKWORKERS']))
+        self.retries = int(service_config['CONTROL']['KRAS4D_CALLBACKRETRIES'])
+        self.backoff = float(service_config['CONTROL']['KRAS4D_CALLBACKBACKOFF'])
+        self.timeout = float(service_config['CONTROL']['KRAS4D_CALLBACKTIMEOUT'])
+        self.batch_size = max(1, int(service_config['CONTROL']['KRAS4D_CALLBACKBATCHSIZE']))
+        self.batch_delay = float(service_config['CONTROL']['KRAS4D_CALLBACKBATCHDELAY'])
+        self.claim_mutex = threading.Lock()
+        self.sessions_mutex = threading.Lock()
+        self.wakeup = threading.Condition()
+        # scheme://netloc -> requests.Session: keep-alive connections are reused for every callback to endpoint
+        self.sessions = dict()
+        self.workers = []
+        self.delivered = 0
+        self.failed = 0
+
+    def final_construct(self, storage):
+        self.storage = storage
+        for request in (CREATE_CALLBACKS_REQUEST, ) + CREATE_CALLBACKS_INDEX_REQUESTS:
+            response, code = self.storage.execute_request(request)
+            if code != 0:
+                self.log.error(f'unable to create callbacks table: {response}')
+                return response, code
+        # callbacks interrupted by restart of this node are delivered again, other nodes keep theirs
+        self.storage.execute_request("UPDATE callbacks SET state = 'pending' WHERE state = 'delivering' AND owner = ?",
+                                     (self.node_name, ))
+        for number in range(self.workers_count):
+            worker = threading.Thread(target=self.worker_func, name=f'callback-{number}', daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        return '', 0
+
+    def enqueue(self, guid, name, clbk, subst):
+        content_type, body = render_callback(clbk, subst)
+        now = time.time()
+        # batched callbacks wait a little for callbacks of other scans to the same endpoint
+        due = now + self.batch_delay if self.batch_size > 1 else now
+        response, code = self.storage.execute_request(f'''
+            INSERT INTO callbacks({", ".join(CALLBACK_COLUMNS[1:])})
+            VALUES (?, ?, ?, ?, ?, 'pending', 0, ?, ?, NULL, NULL, NULL, NULL)
+        ''', (guid, name, clbk['uri'], content_type, body, due, now))
+        if code != 0:
+            self.log.error(f'unable to enqueue callback {name} of scan {guid}: {response}')
+            return response, code
+        with self.wakeup:
+            self.wakeup.notify()
+        return '', 0
+
+    def session(self, uri):
+        parts = urlsplit(uri)
+        base = f'{parts.scheme}://{parts.netloc}'
+        with self.sessions_mutex:
+            if base not in self.sessions:
+                session = requests.Session()
+                session.mount(base, HTTPAdapter(pool_connections=1, pool_maxsize=self.workers_count))
+                self.sessions[base] = session
+            return self.sessions[base]
+
+    def claim(self):
+        # candidates are selected under mutex (workers of this service do not race for the same rows),
+        # rows are taken by conditional update: only one of services sharing database gets every callback
+        with self.claim_mutex:
+            rows, code = self.storage.execute_request(f'''
+                SELECT {", ".join(CALLBACK_COLUMNS)} FROM callbacks WHERE state = 'pending' AND next_attempt <= ?
+                ORDER BY next_attempt LIMIT 1
+            ''', (time.time(), ))
+            if code != 0 or not rows:
+                return []
+            batch = [dict(zip(CALLBACK_COLUMNS, rows[0]))]
+            # text bodies can not be joined: batches are made of json callbacks to the same uri,
+            # new callbacks still waiting for batch delay are taken too
+            if self.batch_size > 1 and batch[0]['content_type'] == 'application/json':
+                rows, code = self.storage.execute_request(f'''
+                    SELECT {", ".join(CALLBACK_COLUMNS)} FROM callbacks WHERE state = 'pending'
+                    AND (next_attempt <= ? OR attempts = 0) AND uri = ? AND content_type = ? AND callback_id != ?
+                    ORDER BY next_attempt LIMIT ?
+                ''', (time.time(), batch[0]['uri'], batch[0]['content_type'], batch[0]['callback_id'],
+                      self.batch_size - 1))
+                if code == 0:
+                    batch.extend(dict(zip(CALLBACK_COLUMNS, row)) for row in rows)
+            ids, claim = [item['callback_id'] for item in batch], str(uuid.uuid4())
+            response, code = self.storage.execute_request(
+                f"UPDATE callbacks SET state = 'delivering', owner = ?, claim = ? "
+                f"WHERE callback_id IN ({', '.join('?' * len(ids))}) AND state = 'pending'",
+                (self.node_name, claim) + tuple(ids))
+            if code != 0:
+                return []
+            rows, code = self.storage.execute_request(
+                f'SELECT {", ".join(CALLBACK_COLUMNS)} FROM callbacks WHERE claim = ? ORDER BY next_attempt',
+                (claim, ))
+            return [dict(zip(CALLBACK_COLUMNS, row)) for row in rows] if code == 0 else []
+
+    def next_due(self):
+        rows, code = self.storage.execute_request(
+            "SELECT MIN(next_attempt) FROM callbacks WHERE state = 'pending'")
+        if code != 0 or not rows or rows[0][0] is None:
+            return self.POLL_PERIOD
+        return min(self.POLL_PERIOD, max(0.0, rows[0][0] - time.time()))
+
+    def worker_func(self):
+        while True:
+            try:
+                batch = self.claim()
+                if not batch:
+                    with self.wakeup:
+                        self.wakeup.wait(self.next_due())
+                    continue
+                self.deliver(batch)
+            except Exception as ex:
+                self.log.error(f'callback worker failed with exception {str(ex)}', exc_info=True)
+                time.sleep(self.POLL_PERIOD)
+
+    def post(self, batch):
+        uri, content_type = batch[0]['uri'], batch[0]['content_type']
+        if len(batch) > 1:
+            data = '[' + ', '.join(item['body'] or 'null' for item in batch) + ']'
+        else:
+            data = batch[0]['body']
+        try:
+            response = self.session(uri).post(uri, headers={'content-type': content_type},
+                                              data=data.encode('utf-8') if data is not None else None,
+                                              timeout=self.timeout)
+        except requests.exceptions.RequestException as ex:
+            return str(ex), True
+        if 200 <= response.status_code < 300:
+            return None, False
+        return f'{response.status_code} {response.reason}', response.status_code in self.RETRY_STATUSES
+
+    def deliver(self, batch):
+        error, retry = self.post(batch)
+        now = time.time()
+        for item in batch:
+            attempts = item['attempts'] + 1
+            if error is None:
+                self.storage.execute_request(
+                    "UPDATE callbacks SET state = 'delivered', attempts = ?, delivered = ?, last_error = NULL "
+                    "WHERE callback_id = ?", (attempts, now, item['callback_id']))
+                self.count('delivered')
+                continue
+            if retry and attempts <= self.retries:
+                delay = min(self.MAX_BACKOFF, self.backoff * 2 ** (attempts - 1))
+                self.storage.execute_request(
+                    "UPDATE callbacks SET state = 'pending', attempts = ?, next_attempt = ?, last_error = ? "
+                    "WHERE callback_id = ?", (attempts, now + delay, error, item['callback_id']))
+                self.log.debug(f'callback {item["name"]} of scan {item["guid"]} failed ({error}), '
+                               f'retry in {delay} seconds')
+            else:
+                self.storage.execute_request(
+                    "UPDATE callbacks SET state = 'failed', attempts = ?, last_error = ? WHERE callback_id = ?",
+                    (attempts, error, item['callback_id']))
+                self.log.warning(f'callback {item["name"]} of scan {item["guid"]} failed: {error}')
+                self.count('failed')
+
+    def count(self, state):
+        with self.sessions_mutex:
+            if state == 'delivered':
+                self.delivered += 1
+            else:
+                self.failed += 1
+
+    def delivery_state(self, guid):
+        rows, code = self.storage.execute_request(
+            'SELECT name, state, attempts, next_attempt, delivered, last_error FROM callbacks WHERE guid = ? '
+            'ORDER BY callback_id', (guid, ))
+        if code != 0:
+            return []
+        state = []
+        for name, status, attempts, next_attempt, delivered, last_error in rows:
+            item = {'callback': name, 'state': status, 'attempts': attempts}
+            if status == 'pending' and attempts:
+                item['next_attempt'] = round(max(0.0, next_attempt - time.time()), 1)
+            if delivered:
+                item['delivered'] = service_util.reformat_datetime_object(datetime.fromtimestamp(delivered))
+            if last_error:
+                item['last_error'] = last_error
+            state.append(item)
+        return state
+
+    def dispatcher_info(self):
+        rows, code = self.storage.execute_request('SELECT state, COUNT(*) FROM callbacks GROUP BY state') \
+            if self.storage else ([], -1)
+        with self.sessions_mutex:
+            return {
+                'workers'  : self.workers_count,
+                'endpoints': len(self.sessions),
+                'queued'   : {state: count for state, count in rows} if code == 0 else {},
+                'delivered': self.delivered,
+                'failed'   : self.failed
+            }
@@ -19,7 +19,27 @@ service_config = dict([
         ('KRAS4D_KEYPATH',  Path(__file__).parent.absolute().joinpath('keys/')),
         ('KRAS4D_LOGPATH',  '/var/log/kaspersky/kesl-service/'),
         ('KRAS4D_LOGLEVEL', 'NOSET'),
-        ('KRAS4D_LOGROTATE', None)
+        ('KRAS4D_LOGROTATE', None),
+        ('KRAS4D_HTTPTHREADS', 32),
+        ('KRAS4D_LONGPOLLTIMEOUT', 300),
+        ('KRAS4D_SSEKEEPALIVE', 15),
+        ('KRAS4D_MAXBODYSIZE', 0),
+        ('KRAS4D_SPOOLCHUNK', 1024 * 1024),
+        ('KRAS4D_SPOOLDIRS', None),
+        ('KRAS4D_SPOOLRAMDIR', '/dev/shm/kesl-service/'),
+        ('KRAS4D_SPOOLRAMTHRESHOLD', 1024 * 1024),
+        ('KRAS4D_SPOOLRAMBUDGET', 256 * 1024 * 1024),
+        ('KRAS4D_STORAGEDRIVER', 'auto'),
+        ('KRAS4D_SQLBATCHSIZE', 256),
+        ('KRAS4D_SQLBATCHDELAY', 0),
+        ('KRAS4D_RETENTIONDAYS', 0),
+        ('KRAS4D_RETENTIONCOUNT', 0),
+        ('KRAS4D_RETENTIONBATCH', 500),
+        ('KRAS4D_RETENTIONPERIOD', 3600),
+        ('KRAS4D_ARCHIVEPATH', None),
+        ('KRAS4D_ARCHIVESEGMENTSIZE', 64 * 1024 * 1024),
+        ('KRAS4D_VACUUMPERIOD', 86400),
+        ('KRAS4D_VACUUMFULL', False)
     ])),
     ('CONTROL', dict([
         ('KRAS4D_XAPIKEY',           None),
@@ -30,7 +50,36 @@ service_config = dict([
         ('KRAS4D_DETECTACTION',      'SKIP'),
         ('KRAS4D_SKIPIMAGEIFEXISTS', False),
         ('KRAS4D_GENERALTIMEOUT',    600),
-        ('KRAS4D_UPDTASKTIMEOUT',    600)
+        ('KRAS4D_UPDTASKTIMEOUT',    600),
+        ('KRAS4D_SCANWORKERS',       4),
+        ('KRAS4D_SCANBATCHSIZE',     64),
+        ('KRAS4D_VERDICTCACHE',      True),
+        ('KRAS4D_VERDICTCACHESIZE',  100000),
+        ('KRAS4D_VERDICTCACHETTL',   604800),
+        ('KRAS4D_PULLWORKERS',       2),
+        ('KRAS4D_SCANSTAGEWORKERS',  1),
+        ('KRAS4D_PUSHWORKERS',       1),
+        ('KRAS4D_PREFETCHIMAGES',    2),
+        ('KRAS4D_IMAGESCANMODE',     'podman'),
+        ('KRAS4D_LAYERWORKERS',      4),
+        ('KRAS4D_BLOBRETRIES',       3),
+        ('KRAS4D_IMAGECACHE',        True),
+        ('KRAS4D_IMAGECACHESIZE',    10 * 1024 * 1024 * 1024),
+        ('KRAS4D_IMAGECACHEPERIOD',  60),
+        ('KRAS4D_REGISTRYPOOLSIZE',  16),
+        ('KRAS4D_REGISTRYRETRIES',   3),
+        ('KRAS4D_REGISTRYBACKOFF',   1),
+        ('KRAS4D_REGISTRYWORKERS',   8),
+        ('KRAS4D_REGISTRYPAGESIZE',  1000),
+        ('KRAS4D_LISTINGCACHETTL',   300),
+        ('KRAS4D_WATCHINTERVAL',     3600),
+        ('KRAS4D_CALLBACKWORKERS',   2),
+        ('KRAS4D_CALLBACKRETRIES',   8),
+        ('KRAS4D_CALLBACKBACKOFF',   2),
+        ('KRAS4D_CALLBACKTIMEOUT',   10),
+        ('KRAS4D_CALLBACKBATCHSIZE', 1),
+        ('KRAS4D_CALLBACKBATCHDELAY', 5),
+        ('KRAS4D_SESSIONCACHESIZE',  1000)
     ])),
     ('HIDDEN', dict([
         ('KRAS4D_CFGNAME',  'kesl-service.config'),
@@ -39,7 +88,8 @@ service_config = dict([
         ('KRAS4D_CRTDATA',  Path(__file__).parent.absolute().joinpath('tmp/cert_storage/')),
         ('KRAS4D_TDFORMAT', '%Y-%m-%dT%H:%M:%S.%f%SZ')
     ])),
-    ('REPOSITORIES', {})
+    ('REPOSITORIES', {}),
+    ('WATCHES', [])
 ])
 
 """
@@ -51,6 +101,26 @@ common:
   certdir: './certificates/'
   logpath: '/var/log/kaspersky/kesl-service/'
   loglevel: 'debug'
+  httpthreads: 32
+  longpolltimeout: 300
+  ssekeepalive: 15
+  maxbodysize: 0
+  spoolchunk: 1048576
+  spooldirs: '/mnt/spool1/,/mnt/spool2/'
+  spoolramdir: '/dev/shm/kesl-service/'
+  spoolramthreshold: 1048576
+  spoolrambudget: 268435456
+  storagedriver: auto
+  sqlbatchsize: 256
+  sqlbatchdelay: 0
+  retentiondays: 90
+  retentioncount: 100000
+  retentionbatch: 500
+  retentionperiod: 3600
+  archivepath: './data/archive/'
+  archivesegmentsize: 67108864
+  vacuumperiod: 86400
+  vacuumfull: False
 control:
   xapikey: 0000
   activation: XXXX-XXXX-XXXX-XXXX or XXXX.key
@@ -61,12 +131,48 @@ control:
   skipimageifexists: False
   generaltimeout: 600
   updtasktimeout: 600
+  scanworkers: 4
+  scanbatchsize: 64
+  verdictcache: True
+  verdictcachesize: 100000
+  verdictcachettl: 604800
+  pullworkers: 2
+  scanstageworkers: 1
+  pushworkers: 1
+  prefetchimages: 2
+  imagescanmode: podman
+  layerworkers: 4
+  blobretries: 3
+  imagecache: true
+  imagecachesize: 10737418240
+  imagecacheperiod: 60
+  registrypoolsize: 16
+  registryretries: 3
+  registrybackoff: 1
+  registryworkers: 8
+  registrypagesize: 1000
+  listingcachettl: 300
+  watchinterval: 3600
+  callbackworkers: 2
+  callbackretries: 8
+  callbackbackoff: 2
+  callbacktimeout: 10
+  callbackbatchsize: 1
+  callbackbatchdelay: 5
+  sessioncachesize: 1000
 repositories:
   cos-docker-reg.avp.ru:
     certificate: cert.pem
     credentials:
       user: user
       pass: password
+watches:
+  - source: 'https://cos-docker-reg.avp.ru/team/*:release-*'
+    interval: 3600
+    params:
+      custom_callbacks:
+        on_complete:
+          uri: 'http://127.0.0.1:8080/scans'
 """
 
 
@@ -124,6 +230,8 @@ def get_config():
                 set_var('CONTROL', body['control']) if 'control' in body else None
                 if 'repositories' in body:
                     copy_registry(body['repositories'])
+                if 'watches' in body and isinstance(body['watches'], list):
+                    service_config['WATCHES'] = body['watches']
             except yaml.YAMLError as ex:
                 print(f'bad yaml file {config_name}: {ex}, use default configuration before apply environments')
     else:
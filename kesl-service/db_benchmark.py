@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+#
+# compare scans database access: shared connection with commit per request (legacy) and
+# WAL + batched writer thread + read-only reader connections (ScansStorage), e.g.:
+#   python3 db_benchmark.py --writers 16 --records 2000 --readers 4
+#
+import time
+import uuid
+import argparse
+import tempfile
+import threading
+import statistics
+import sqlite3 as sql
+from pathlib import Path
+import control  # noqa: F401 (must be imported before configurator users)
+import service_types
+from db_control import ScansStorage, CREATE_DB_REQUEST
+
+
+class LegacyStorage(ScansStorage):
+    """
+    database access before WAL: one shared connection, every request is committed on its own
+    """
+
+    def connect(self):
+        self.conn = sql.connect(self.path_uri, uri=True, check_same_thread=False)
+        with self.conn as conn:
+            conn.execute(CREATE_DB_REQUEST)
+        return self.migrate()
+
+    def execute_request(self, request, data=None):
+        try:
+            with self.conn as conn:
+                cursor = conn.cursor()
+                cursor.execute(request, data) if data else cursor.execute(request)
+                conn.commit()
+                return cursor.fetchall(), 0
+        except Exception as e:
+            # shared connection is not safe for concurrent use: errors are counted, not raised
+            return str(e), -1
+
+
+def new_session():
+    scan_session = service_types.new_scan_session()
+    scan_session['scan_summary'].update({'status': 'created', 'scan_params': {}})
+    scan_session['session_info'].update({'type': 'stream', 'items': {f'file_{n}': f'/tmp/{n}' for n in range(8)}})
+    return scan_session
+
+
+def percentile(values, fraction):
+    return sorted(values)[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def benchmark_storage(storage_class, path, writers, records, readers):
+    storage = storage_class()
+    storage.final_construct(path)
+    response, code = storage.connect()
+    if code != 0:
+        print(f'{storage_class.__name__}: unable to open database ({response})')
+        return None
+    errors, latencies, writing = [0], [], threading.Event()
+    guids = [str(uuid.uuid4()) for _ in range(writers * records)]
+    stat_mutex = threading.Lock()
+
+    def writer(number):
+        session = new_session()
+        for guid in guids[number * records:(number + 1) * records]:
+            _, add_code = storage.add_record(guid, session)
+            session['scan_summary']['status'] = 'completed'
+            _, update_code = storage.db_full_update(guid, session)
+            if add_code != 0 or update_code != 0:
+                with stat_mutex:
+                    errors[0] += 1
+
+    def reader():
+        while writing.is_set():
+            start = time.monotonic()
+            storage.execute_request('SELECT guid, status FROM scans WHERE guid = ?', (guids[0],))
+            with stat_mutex:
+                latencies.append(time.monotonic() - start)
+            time.sleep(0.001)
+
+    writing.set()
+    reader_threads = [threading.Thread(target=reader) for _ in range(readers)]
+    writer_threads = [threading.Thread(target=writer, args=(number,)) for number in range(writers)]
+    start = time.monotonic()
+    for thread in reader_threads + writer_threads:
+        thread.start()
+    for thread in writer_threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+    writing.clear()
+    for thread in reader_threads:
+        thread.join()
+    return {
+        'writes/s': 2 * len(guids) / elapsed,
+        'errors'  : errors[0],
+        'read p50': statistics.median(latencies) * 1000 if latencies else 0.0,
+        'read p99': percentile(latencies, 0.99) * 1000
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='scans database benchmark')
+    parser.add_argument('--writers', type=int, default=16, help='concurrent writer threads')
+    parser.add_argument('--records', type=int, default=500, help='scans added and updated by every writer')
+    parser.add_argument('--readers', type=int, default=4, help='concurrent reader threads')
+    parser.add_argument('--directory', default=None, help='database directory (default: temporary)')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        results = {
+            'legacy'     : benchmark_storage(LegacyStorage, Path(directory).joinpath('legacy.sqlite'),
+                                             args.writers, args.records, args.readers),
+            'wal+batched': benchmark_storage(ScansStorage, Path(directory).joinpath('wal.sqlite'),
+                                             args.writers, args.records, args.readers)
+        }
+    print(f'{"storage":<14}{"writes/s":>10}{"errors":>8}{"read p50, ms":>14}{"read p99, ms":>14}')
+    for name in results:
+        if results[name]:
+            print(f'{name:<14}{results[name]["writes/s"]:>10.0f}{results[name]["errors"]:>8}'
+                  f'{results[name]["read p50"]:>14.2f}{results[name]["read p99"]:>14.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,13 @@
 import json
+import time
+import queue
 import logging
+import threading
 import service_util
 import sqlite3 as sql
 from pathlib import Path
+from datetime import datetime
+from configurator import service_config
 
 CREATE_DB_REQUEST = '''
     CREATE TABLE IF NOT EXISTS scans(
@@ -19,13 +24,91 @@ CREATE_DB_REQUEST = '''
 '''
 
 
+# columns in order of service_types.scan_session_scheme
+SCAN_COLUMNS = 'guid, status, created, completed, progress, scan_params, scan_errors, scan_result, scan_session'
+
+# every write takes the next version: rows changed by any service sharing the database are found by version,
+# counter is kept in its own row (moved forward by triggers): deleted rows do not take their versions back
+NEXT_VERSION = '(SELECT version + 1 FROM scans_counter)'
+
+# schema changes applied in order to databases with lower PRAGMA user_version
+MIGRATIONS = (
+    (
+        'ALTER TABLE scans ADD COLUMN verdict TEXT',
+        # created is ISO text with local offset: not comparable as text across offsets (DST, TZ changes)
+        'ALTER TABLE scans ADD COLUMN created_ts REAL',
+        'CREATE INDEX IF NOT EXISTS scans_created ON scans(created_ts, guid)',
+        'CREATE INDEX IF NOT EXISTS scans_status ON scans(status, created_ts, guid)',
+        'CREATE INDEX IF NOT EXISTS scans_verdict ON scans(verdict, created_ts, guid)'
+    ),
+    (
+        'ALTER TABLE scans ADD COLUMN version INTEGER NOT NULL DEFAULT 0',
+        'CREATE INDEX IF NOT EXISTS scans_version ON scans(version)',
+        'CREATE TABLE IF NOT EXISTS scans_counter(id INTEGER PRIMARY KEY CHECK (id = 0), version INTEGER NOT NULL)',
+        'INSERT OR IGNORE INTO scans_counter(id, version) SELECT 0, COALESCE(MAX(version), 0) FROM scans',
+        '''CREATE TRIGGER IF NOT EXISTS scans_version_insert AFTER INSERT ON scans BEGIN
+            UPDATE scans_counter SET version = NEW.version WHERE NEW.version > version; END''',
+        '''CREATE TRIGGER IF NOT EXISTS scans_version_update AFTER UPDATE OF version ON scans BEGIN
+            UPDATE scans_counter SET version = NEW.version WHERE NEW.version > version; END'''
+    ),
+)
+
+VERDICT_ORDER = ('infected', 'error', 'non scanned', 'skipped', 'clean')
+
+
+def compact_json(value):
+    # no indents: session columns are the bulk of database size
+    return json.dumps(value, separators=(',', ':'), default=service_util.json_default_decode)
+
+
+def created_timestamp(created):
+    """
+    epoch seconds of scan creation date, None if date is unknown
+    """
+    try:
+        return datetime.fromisoformat(created).timestamp() if created else None
+    except (TypeError, ValueError):
+        return None
+
+
+def session_verdict(scan_result):
+    """
+    the worst item verdict of scan, None while there are no results
+    """
+    verdicts = {'error' if 'verdict' not in item else item['verdict'] for item in (scan_result or {}).values()
+                if isinstance(item, dict)}
+    for verdict in VERDICT_ORDER:
+        if verdict in verdicts:
+            return verdict
+    return None
+
+
+class WriteRequest:
+
+    def __init__(self, request, data, exclusive=False):
+        self.request = request
+        self.data = data
+        # executed alone and outside of transaction (VACUUM, some PRAGMAs)
+        self.exclusive = exclusive
+        self.response = None
+        self.code = -1
+        self.done = threading.Event()
+
+
 class ScansStorage:
 
+    READ_STATEMENTS = ('SELECT', 'WITH')
+
     def __init__(self):
         self.conn = None
         self.path = None
         self.path_uri = None
         self.slog = logging.getLogger('main.db_conn')
+        self.batch_size = max(1, int(service_config['COMMON']['KRAS4D_SQLBATCHSIZE']))
+        self.batch_delay = float(service_config['COMMON']['KRAS4D_SQLBATCHDELAY']) / 1000
+        self.write_queue = queue.Queue()
+        self.readers = threading.local()
+        self.writer = None
 
     def final_construct(self, database_path):
         self.path = Path(database_path)
@@ -34,37 +117,89 @@ class ScansStorage:
     def create_database(self):
         self.slog.debug(f'database not found. try to create {self.path_uri}')
         self.path.parent.mkdir(parents=True, exist_ok=True)
-        conn = sql.connect(self.path_uri, uri=True, check_same_thread=False)
-        with conn:
-            cursor = conn.cursor()
-            cursor.execute(CREATE_DB_REQUEST)
+        conn = sql.connect(self.path_uri, uri=True, check_same_thread=False, isolation_level=None)
+        conn.execute(CREATE_DB_REQUEST)
         return conn
 
     def connect(self):
         try:
             self.slog.debug(f'try to establish connection with {self.path_uri}')
-            self.conn = sql.connect(self.path_uri, uri=True, check_same_thread=False) if self.path.exists() \
-                else self.create_database()
+            self.conn = sql.connect(self.path_uri, uri=True, check_same_thread=False, isolation_level=None) \
+                if self.path.exists() else self.create_database()
+            # readers do not block the writer and the writer does not block readers
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.writer = threading.Thread(target=self.writer_func, name='db-writer', daemon=True)
+            self.writer.start()
             self.slog.debug(f'connection with {self.path_uri} established')
-            return 'success', 0
+            return self.migrate()
         except sql.OperationalError as e:
             return f'unable to construct database with operation error {str(e)}', -1
         except (OSError, ValueError) as e:
             return f'unable to construct database with exception {str(e)}', -1
 
+    def migrate(self):
+        rows, code = self.execute_request('PRAGMA user_version')
+        if code != 0:
+            return f'unable to read database version: {rows}', code
+        version = rows[0][0]
+        for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+            self.slog.info(f'migrate database to version {number}')
+            for request in migration:
+                response, code = self.execute_request(request)
+                if code != 0:
+                    return f'unable to migrate database to version {number}: {response}', code
+            if number == 1:
+                self.fill_verdicts()
+                self.fill_created_timestamps()
+            self.execute_request(f'PRAGMA user_version = {number}')
+        return 'success', 0
+
+    def fill_verdicts(self):
+        rows, code = self.execute_request('SELECT guid, scan_result FROM scans')
+        for guid, scan_result in rows if code == 0 else []:
+            try:
+                verdict = session_verdict(json.loads(scan_result) if scan_result else None)
+            except ValueError:
+                continue
+            self.execute_request('UPDATE scans SET verdict = ? WHERE guid = ?', (verdict, guid))
+
+    def fill_created_timestamps(self):
+        rows, code = self.execute_request('SELECT guid, created FROM scans')
+        for guid, created in rows if code == 0 else []:
+            self.execute_request('UPDATE scans SET created_ts = ? WHERE guid = ?', (created_timestamp(created), guid))
+
+    def reader(self):
+        # every thread reads with its own read-only connection
+        if getattr(self.readers, 'conn', None) is None:
+            self.readers.conn = sql.connect('{}?mode=ro'.format(self.path.as_uri()), uri=True)
+        return self.readers.conn
+
     def execute_request(self, request, data=None):
+        if not self.conn:
+            print(f'unable to request to database because connection not established')
+            return 'connection not established', -1
+        if request.lstrip().upper().startswith(self.READ_STATEMENTS):
+            return self.execute_read(request, data)
+        # writes are serialized by writer thread, caller waits for commit of the batch
+        write_request = WriteRequest(request, data)
+        self.write_queue.put(write_request)
+        write_request.done.wait()
+        return write_request.response, write_request.code
+
+    def execute_exclusive(self, request):
+        if not self.conn:
+            return 'connection not established', -1
+        write_request = WriteRequest(request, None, True)
+        self.write_queue.put(write_request)
+        write_request.done.wait()
+        return write_request.response, write_request.code
+
+    def execute_read(self, request, data):
         try:
-            if self.conn:
-                with self.conn as conn:
-                    cursor = conn.cursor()
-                    cursor.execute(request, data) if data else cursor.execute(request)
-                    conn.commit()
-                    return cursor.fetchall(), 0
-            else:
-                print(f'unable to request to database because connection not established')
-        except sql.IntegrityError as e:
-            self.slog.error(f'SQL IntegrityError exception: {str(e)}')
-            return str(e), -1
+            cursor = self.reader().cursor()
+            cursor.execute(request, data) if data else cursor.execute(request)
+            return cursor.fetchall(), 0
         except sql.OperationalError as e:
             self.slog.error(f'SQL OperationalError exception: {str(e)}')
             return str(e), -1
@@ -72,19 +207,88 @@ class ScansStorage:
             self.slog.error(f'SQL other exception: {str(e)}')
             return str(e), -1
 
+    def writer_func(self):
+        pending = None
+        while True:
+            batch, pending = [pending or self.write_queue.get()], None
+            if batch[0].exclusive:
+                self.write_exclusive(batch[0])
+                continue
+            # requests queued while previous batch was committed (and during optional batch delay)
+            # are committed with one transaction
+            deadline = time.monotonic() + self.batch_delay
+            while len(batch) < self.batch_size:
+                try:
+                    write_request = self.write_queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if write_request.exclusive:
+                    pending = write_request
+                    break
+                batch.append(write_request)
+            self.write_batch(batch)
+
+    def write_exclusive(self, write_request):
+        try:
+            write_request.response, write_request.code = self.conn.execute(write_request.request).fetchall(), 0
+        except Exception as e:
+            self.slog.error(f'SQL exception: {str(e)}')
+            write_request.response, write_request.code = str(e), -1
+        write_request.done.set()
+
+    def write_batch(self, batch):
+        try:
+            self.conn.execute('BEGIN IMMEDIATE')
+            for write_request in batch:
+                self.write_one(write_request)
+            self.conn.execute('COMMIT')
+        except Exception as e:
+            self.slog.error(f'SQL batch exception: {str(e)}')
+            if self.conn.in_transaction:
+                self.conn.execute('ROLLBACK')
+            for write_request in batch:
+                if write_request.code == 0:
+                    write_request.response, write_request.code = str(e), -1
+        for write_request in batch:
+            write_request.done.set()
+
+    def write_one(self, write_request):
+        # failed request is rolled back alone, the rest of the batch is committed
+        cursor = self.conn.cursor()
+        cursor.execute('SAVEPOINT request')
+        try:
+            cursor.execute(write_request.request, write_request.data) if write_request.data \
+                else cursor.execute(write_request.request)
+            write_request.response, write_request.code = cursor.fetchall(), 0
+            cursor.execute('RELEASE request')
+        except sql.IntegrityError as e:
+            self.slog.error(f'SQL IntegrityError exception: {str(e)}')
+            write_request.response, write_request.code = str(e), -1
+        except sql.OperationalError as e:
+            self.slog.error(f'SQL OperationalError exception: {str(e)}')
+            write_request.response, write_request.code = str(e), -1
+        except Exception as e:
+            self.slog.error(f'SQL other exception: {str(e)}')
+            write_request.response, write_request.code = str(e), -1
+        if write_request.code != 0:
+            cursor.execute('ROLLBACK TO request')
+            cursor.execute('RELEASE request')
+
     def add_record(self, scan_guid, scan_session):
         request = """ \
             INSERT INTO scans(guid, status, created, completed, progress, scan_params,
-            scan_errors, scan_result, scan_session) \
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """
+            scan_errors, scan_result, scan_session, verdict, created_ts, version) \
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, {})
+        """.format(NEXT_VERSION)
         data_tuple = (
             scan_guid, scan_session['scan_summary']['status'], scan_session['scan_summary']['created'],
             scan_session['scan_summary']['completed'], scan_session['scan_summary']['progress'],
-            json.dumps(scan_session['scan_summary']['scan_params'], indent=4, default=service_util.json_default_decode),
-            json.dumps(scan_session['scan_summary']['scan_errors'], indent=4, default=service_util.json_default_decode),
-            json.dumps(scan_session['scan_summary']['scan_result'], indent=4, default=service_util.json_default_decode),
-            json.dumps(scan_session['session_info'], indent=4, default=service_util.json_default_decode))
+            compact_json(scan_session['scan_summary']['scan_params']),
+            compact_json(scan_session['scan_summary']['scan_errors']),
+            compact_json(scan_session['scan_summary']['scan_result']),
+            compact_json(scan_session['session_info']),
+            session_verdict(scan_session['scan_summary']['scan_result']),
+            created_timestamp(scan_session['scan_summary']['created']))
         response, app_code = self.execute_request(request, data_tuple)
         self.slog.debug(f'add new scan with guid {scan_guid} result: {app_code}')
         return response, app_code
@@ -92,7 +296,7 @@ class ScansStorage:
     @staticmethod
     def service_convert(item, data):
         try:
-            tmp = json.dumps(item[data], indent=4, default=service_util.json_default_decode)
+            tmp = compact_json(item[data])
             return tmp
         except (KeyError, ValueError):
             return None
@@ -100,20 +304,100 @@ class ScansStorage:
     def db_full_update(self, scan_guid, scan_session):
         request = """ \
             UPDATE scans SET status = ?, created = ?, completed = ?, progress = ?, scan_params = ?,
-            scan_errors = ?, scan_result = ?, scan_session = ? WHERE guid = ?
-        """
+            scan_errors = ?, scan_result = ?, scan_session = ?, verdict = ?, created_ts = ?, version = {}
+            WHERE guid = ?
+        """.format(NEXT_VERSION)
         data_tuple = (
             scan_session['scan_summary']['status'], scan_session['scan_summary']['created'],
             scan_session['scan_summary']['completed'], scan_session['scan_summary']['progress'],
             self.service_convert(scan_session['scan_summary'], 'scan_params'),
             self.service_convert(scan_session['scan_summary'], 'scan_errors'),
             self.service_convert(scan_session['scan_summary'], 'scan_result'),
-            json.dumps(scan_session['session_info'], indent=4, default=service_util.json_default_decode),
-            scan_guid)
+            compact_json(scan_session['session_info']),
+            session_verdict(scan_session['scan_summary'].get('scan_result')),
+            created_timestamp(scan_session['scan_summary']['created']), scan_guid)
         response, app_code = self.execute_request(request, data_tuple)
         return response, app_code
 
-    def db_get_records(self):
-        request = """ SELECT * FROM scans """
-        response, code = self.execute_request(request)
+    def db_get_records(self, statuses=None):
+        if statuses is None:
+            return self.execute_request(f""" SELECT {SCAN_COLUMNS} FROM scans """)
+        request = f""" SELECT {SCAN_COLUMNS} FROM scans WHERE status IN ({', '.join('?' * len(statuses))}) """
+        response, code = self.execute_request(request, tuple(statuses))
         return response, code
+
+    def db_get_record(self, scan_guid):
+        return self.execute_request(f""" SELECT {SCAN_COLUMNS} FROM scans WHERE guid = ? """, (scan_guid, ))
+
+    def db_get_version(self):
+        rows, code = self.execute_request(""" SELECT version FROM scans_counter """)
+        return (rows[0][0], 0) if code == 0 else (rows, code)
+
+    def db_get_changes(self, version):
+        """
+        (guid, status, version) of rows written after version, sessions are not parsed here
+        """
+        request = f""" SELECT guid, status, version FROM scans WHERE version > ? ORDER BY version """
+        return self.execute_request(request, (version, ))
+
+    def db_find_records(self, filters, cursor, limit):
+        """
+        scans page ordered from newest to oldest, filters: {column: value} for status and verdict,
+        {'created_after': epoch, 'created_before': epoch}; cursor is (created_ts, guid) of last scan of previous page
+        """
+        conditions, data = [], []
+        for column in ('status', 'verdict'):
+            if filters.get(column) is not None:
+                conditions.append(f'{column} = ?')
+                data.append(filters[column])
+        if filters.get('created_after') is not None:
+            conditions.append('created_ts >= ?')
+            data.append(filters['created_after'])
+        if filters.get('created_before') is not None:
+            conditions.append('created_ts < ?')
+            data.append(filters['created_before'])
+        if cursor is not None:
+            conditions.append('(created_ts, guid) < (?, ?)')
+            data.extend(cursor)
+        request = f"""
+            SELECT guid, status, created, completed, progress, verdict, created_ts FROM scans
+            {'WHERE ' + ' AND '.join(conditions) if conditions else ''} ORDER BY created_ts DESC, guid DESC LIMIT ?
+        """
+        return self.execute_request(request, tuple(data) + (limit, ))
+
+    def db_expired_records(self, created_before, keep_count, limit):
+        """
+        oldest completed scans which are created before epoch or are not among keep_count newest ones
+        """
+        if created_before is not None:
+            request = f""" SELECT {SCAN_COLUMNS}, verdict FROM scans WHERE status = 'completed' AND created_ts < ?
+                ORDER BY created_ts, guid LIMIT ? """
+            rows, code = self.execute_request(request, (created_before, limit))
+            if code != 0 or rows or not keep_count:
+                return rows, code
+        if not keep_count:
+            return [], 0
+        request = f""" SELECT {SCAN_COLUMNS}, verdict FROM scans WHERE status = 'completed'
+            ORDER BY created_ts DESC, guid DESC LIMIT ? OFFSET ? """
+        return self.execute_request(request, (limit, keep_count))
+
+    def db_delete_records(self, scan_guids):
+        placeholders = ', '.join('?' * len(scan_guids))
+        return self.execute_request(f""" DELETE FROM scans WHERE guid IN ({placeholders}) """, tuple(scan_guids))
+
+    def db_compact_records(self, limit):
+        """
+        re-writes session columns written with indents by previous versions, returns number of rows
+        """
+        rows, code = self.execute_request(f""" SELECT guid, scan_params, scan_errors, scan_result, scan_session
+            FROM scans WHERE status = 'completed' AND instr(scan_session, char(10)) > 0 LIMIT ? """, (limit, ))
+        if code != 0:
+            return rows, code
+        for row in rows:
+            try:
+                columns = [compact_json(json.loads(value)) if value else value for value in row[1:]]
+            except ValueError:
+                continue
+            self.execute_request(""" UPDATE scans SET scan_params = ?, scan_errors = ?, scan_result = ?,
+                scan_session = ? WHERE guid = ? AND instr(scan_session, char(10)) > 0 """, tuple(columns) + (row[0], ))
+        return len(rows), 0
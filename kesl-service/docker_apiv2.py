@@ -1,77 +1,419 @@
+import re
+import time
 import shlex
 import base64
+import hashlib
 import urllib3
 import fnmatch
 import logging
 import requests
+import threading
 import service_util
-from urllib.parse import urlparse
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, urljoin, urlencode
+from email.utils import parsedate_to_datetime
 from configurator import service_config
+from service_types import SpecSingleton
 
+MANIFEST_LIST_TYPES = (
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.index.v1+json'
+)
 
-def request_apiv2_route_token(www_authenticate, headers, cert):
-    method, route_part = www_authenticate.split(' ', 2)
-    route_dict = dict([item.split('=') for item in route_part.split(',')])
-    authenticate_route = \
-        (route_dict['realm'].strip('"') if 'realm' in route_dict else '') + \
-        (('?service=' + route_dict['service'].strip('"')) if 'service' in route_dict else '') + \
-        (('?scope=' + route_dict['scope'].strip('"')) if 'scope' in route_dict else '')
-    response = requests.get(authenticate_route, headers=headers, verify=cert)
+MANIFEST_ACCEPT = ', '.join((
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.oci.image.manifest.v1+json'
+) + MANIFEST_LIST_TYPES)
+
+
+class RegistrySessions(metaclass=SpecSingleton):
+    """
+    keep-alive sessions per registry and bearer tokens cached by (realm, service, scope) until expiration
+    """
+
+    RETRY_CODES   = (429, 502, 503, 504)
+    TOKEN_MARGIN  = 10
+    TOKEN_DEFAULT = 60
+
+    def __init__(self):
+        self.log = logging.getLogger('main.registry')
+        self.mutex = threading.Lock()
+        self.sessions = dict()
+        # (registry, repository, user) -> challenge parameters
+        self.challenges = dict()
+        # (realm, service, scope, user) -> (token, expiration)
+        self.tokens = dict()
+
+    @staticmethod
+    def route_base(route):
+        route_parts = urlparse(route)
+        return f'{route_parts.scheme}://{route_parts.netloc}'
+
+    @staticmethod
+    def route_repository(route):
+        # /v2/<name>/manifests/<ref>, /v2/<name>/blobs/<digest>, /v2/<name>/tags/list, /v2/_catalog
+        path = urlparse(route).path[len('/v2/'):]
+        for separator in ('/manifests/', '/blobs/', '/tags/'):
+            if separator in path:
+                return path.split(separator, 1)[0]
+        return path
+
+    def session(self, route):
+        base = self.route_base(route)
+        with self.mutex:
+            if base not in self.sessions:
+                pool_size = int(service_config['CONTROL']['KRAS4D_REGISTRYPOOLSIZE'])
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.sessions[base] = session
+            return self.sessions[base]
+
+    def request(self, method, route, headers, cert, stream=False, params=None):
+        retries = max(0, int(service_config['CONTROL']['KRAS4D_REGISTRYRETRIES']))
+        timeout = int(service_config['CONTROL']['KRAS4D_GENERALTIMEOUT'])
+        for attempt in range(retries + 1):
+            try:
+                response = self.session(route).request(method, route, headers=headers, verify=cert, stream=stream,
+                                                       params=params, timeout=timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as ex:
+                if attempt == retries:
+                    raise
+                delay = self.backoff(attempt)
+                self.log.debug(f'{route}: {ex}, retry in {delay:.1f}s')
+            else:
+                if response.status_code not in self.RETRY_CODES or attempt == retries:
+                    return response
+                delay = self.retry_after(response, attempt)
+                self.log.debug(f'{route}: {response.status_code} {response.reason}, retry in {delay:.1f}s')
+                response.close()
+            time.sleep(delay)
+
+    @staticmethod
+    def backoff(attempt):
+        return min(float(service_config['CONTROL']['KRAS4D_REGISTRYBACKOFF']) * (2 ** attempt), 60.0)
+
+    def retry_after(self, response, attempt):
+        # rate limited registries tell when to come back
+        retry_after = response.headers.get('Retry-After')
+        if retry_after:
+            try:
+                return min(max(0.0, float(retry_after)), 300.0)
+            except ValueError:
+                try:
+                    return min(max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time()), 300.0)
+                except (TypeError, ValueError):
+                    pass
+        reset = response.headers.get('X-RateLimit-Reset') or response.headers.get('RateLimit-Reset')
+        if reset and reset.isdigit():
+            # epoch seconds or seconds to wait
+            delay = int(reset) - time.time() if int(reset) > time.time() else int(reset)
+            return min(max(0.0, delay), 300.0)
+        return self.backoff(attempt)
+
+    def cached_token(self, route, user_name):
+        with self.mutex:
+            challenge = self.challenges.get((self.route_base(route), self.route_repository(route), user_name))
+            if challenge is None:
+                return None
+            token, expiration = self.tokens.get(challenge + (user_name,), (None, 0))
+            return token if expiration > time.time() else None
+
+    def store_token(self, route, user_name, challenge, token, expires_in):
+        with self.mutex:
+            self.challenges[(self.route_base(route), self.route_repository(route), user_name)] = challenge
+            self.tokens[challenge + (user_name,)] = (token, time.time() + max(0, expires_in - self.TOKEN_MARGIN))
+
+    def drop_token(self, route, user_name):
+        with self.mutex:
+            challenge = self.challenges.pop((self.route_base(route), self.route_repository(route), user_name), None)
+            if challenge is not None:
+                self.tokens.pop(challenge + (user_name,), None)
+
+
+def basic_authorization(user_name, user_pass):
+    return 'Basic ' + base64.b64encode((user_name + ':' + user_pass).encode('utf-8')).decode('utf-8')
+
+
+def request_apiv2_route_token(route, www_authenticate, user_name=None, user_pass=None, cert=None):
+    method, _, route_part = www_authenticate.partition(' ')
+    if method.lower() != 'bearer':
+        return f'unsupported authentication method {method}', 401
+    route_dict = dict(re.findall(r'(\w+)="([^"]*)"', route_part))
+    challenge = (route_dict.get('realm', ''), route_dict.get('service', ''), route_dict.get('scope', ''))
+    registry = RegistrySessions()
+    headers = {'User-Agent': 'Docker-Client (linux)'}
+    if user_name is not None and user_pass is not None:
+        headers.update({'Authorization': basic_authorization(user_name, user_pass)})
+    params = {key: value for key, value in (('service', challenge[1]), ('scope', challenge[2])) if value}
+    response = registry.request('GET', challenge[0], headers, cert, params=params)
     if response.status_code == 200:
         response_body = response.json()
-        return method + ' ' + (response_body.get('access-token') or response_body['token']), 200
+        token = 'Bearer ' + (response_body.get('token') or response_body['access_token'])
+        registry.store_token(route, user_name, challenge, token,
+                             int(response_body.get('expires_in') or RegistrySessions.TOKEN_DEFAULT))
+        return token, 200
     return response.reason, response.status_code
 
 
-def request_apiv2_route(route, token=None, user_name=None, user_pass=None, cert=None):
+def request_apiv2_route(route, token=None, user_name=None, user_pass=None, cert=None, extra_headers=None,
+                        stream=False, method='GET'):
+    registry = RegistrySessions()
     headers = {'User-Agent': 'Docker-Client (linux)'}
     headers.update({'Content-Type': 'application/json'})
+    if extra_headers is not None:
+        headers.update(extra_headers)
     try:
-        if token is None:
-            if user_name is not None and user_pass is not None:
-                headers.update({
-                    'Authorization':
-                        'Basic ' + base64.b64encode((user_name + ':' + user_pass).encode('utf-8')).decode('utf-8')
-                })
-            response = requests.get(route, headers=headers, verify=cert)
-            if response.status_code == 401 and 'Www-Authenticate' in response.headers:
-                token, code = request_apiv2_route_token(
-                    response.headers['Www-Authenticate'], headers=headers, cert=cert)
-                return request_apiv2_route(route, token=token, cert=cert) if code == 200 else (token, code)
-            return response.json() if response.status_code == 200 else response.reason, \
-                response.headers if response.status_code == 200 else None, response.status_code
-        else:
-            headers.update({
-                'Authorization': '{}'.format(token)
-            })
-            response = requests.get(route, headers=headers, verify=cert)
-            return response.json() if response.status_code == 200 else response.reason, \
-                response.headers if response.status_code == 200 else None, response.status_code
+        token = token if token is not None else registry.cached_token(route, user_name)
+        if token is not None:
+            headers.update({'Authorization': token})
+        elif user_name is not None and user_pass is not None:
+            headers.update({'Authorization': basic_authorization(user_name, user_pass)})
+        response = registry.request(method, route, headers, cert, stream)
+        if response.status_code == 401 and 'Www-Authenticate' in response.headers:
+            # no token for this scope yet, or cached one was revoked
+            response.close()
+            registry.drop_token(route, user_name)
+            token, code = request_apiv2_route_token(route, response.headers['Www-Authenticate'],
+                                                    user_name, user_pass, cert)
+            if code != 200:
+                return token, None, code
+            headers.update({'Authorization': token})
+            response = registry.request(method, route, headers, cert, stream)
+        if response.status_code not in (200, 206):
+            response.close()
+            return response.reason, None, response.status_code
+        # streamed body (blobs) is consumed by the caller, HEAD has no body
+        return response if stream else response.json() if method != 'HEAD' else '', response.headers, \
+            response.status_code
     except requests.exceptions.RequestException as e:
         return str(e), None, 500
 
 
+class RegistryListing:
+    """
+    catalog / tags listing: next pages are requested while the caller iterates
+    """
+
+    LINK_NEXT = re.compile(r'<([^>]+)>\s*;\s*rel="?next"?')
+
+    def __init__(self, route, field, page, headers, user_name=None, user_pass=None, cert=None):
+        self.route = route
+        self.field = field
+        self.page = page
+        self.headers = headers
+        self.credentials = (user_name, user_pass, cert)
+        self.error = None
+        self.complete = False
+
+    def next_route(self, items):
+        # Link header is preferred, n/last is the fallback for registries without it
+        link = self.LINK_NEXT.search(self.headers.get('Link', '')) if self.headers else None
+        if link:
+            return urljoin(self.route, link.group(1))
+        page_size = int(service_config['CONTROL']['KRAS4D_REGISTRYPAGESIZE'])
+        if items and len(items) >= page_size:
+            return f'{self.route}?{urlencode({"n": page_size, "last": items[-1]})}'
+        return None
+
+    def __iter__(self):
+        last = None
+        while True:
+            items = self.page.get(self.field) or []
+            if items and items[-1] == last:
+                # registry ignores pagination and repeats the page: it was already yielded
+                self.complete = True
+                return
+            yield from items
+            route = self.next_route(items)
+            if route is None:
+                self.complete = True
+                return
+            last = items[-1] if items else None
+            self.page, self.headers, code = request_apiv2_route(route, user_name=self.credentials[0],
+                                                                user_pass=self.credentials[1], cert=self.credentials[2])
+            if code != 200:
+                logging.warning(f'{route}: listing interrupted with {code} {self.page}')
+                self.error = self.page
+                return
+
+
+class ListingCache(metaclass=SpecSingleton):
+    """
+    filtered catalog and tags listings, kept for listingcachettl seconds
+    """
+
+    MAX_ENTRIES = 10000
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.listings = dict()
+
+    @staticmethod
+    def ttl():
+        return int(service_config['CONTROL']['KRAS4D_LISTINGCACHETTL'])
+
+    def lookup(self, key):
+        with self.mutex:
+            matched, expiration = self.listings.get(key, (None, 0))
+            return list(matched) if matched is not None and expiration > time.time() else None
+
+    def store(self, key, matched):
+        if self.ttl() <= 0:
+            return
+        with self.mutex:
+            if len(self.listings) >= self.MAX_ENTRIES:
+                now = time.time()
+                self.listings = {item: value for item, value in self.listings.items() if value[1] > now}
+                if len(self.listings) >= self.MAX_ENTRIES:
+                    # insertion order: drop the oldest half
+                    self.listings = dict(list(self.listings.items())[self.MAX_ENTRIES // 2:])
+            self.listings[key] = (list(matched), time.time() + self.ttl())
+
+
+def request_listing(route, field, user_name=None, user_pass=None, cert=None):
+    page_size = int(service_config['CONTROL']['KRAS4D_REGISTRYPAGESIZE'])
+    page, headers, code = request_apiv2_route(f'{route}?n={page_size}', user_name=user_name, user_pass=user_pass,
+                                              cert=cert)
+    if code != 200:
+        return page, None, code
+    return RegistryListing(route, field, page, headers, user_name, user_pass, cert), headers, code
+
+
 def request_images(request_data, user_name=None, user_pass=None, cert=None):
     apiv2_route = '{}://{}/v2/_catalog'.format(request_data['context']['repository_schm'],
                                                request_data['context']['repository'])
-    return request_apiv2_route(apiv2_route, user_name=user_name, user_pass=user_pass, cert=cert)
+    return request_listing(apiv2_route, 'repositories', user_name=user_name, user_pass=user_pass, cert=cert)
 
 
 def request_tags(request_data, image_name, user_name=None, user_pass=None, cert=None):
     apiv2_route = '{}://{}/v2/{}/tags/list'.format(request_data['context']['repository_schm'],
                                                    request_data['context']['repository'], image_name)
-    return request_apiv2_route(apiv2_route, user_name=user_name, user_pass=user_pass, cert=cert)
+    return request_listing(apiv2_route, 'tags', user_name=user_name, user_pass=user_pass, cert=cert)
+
+
+def filter_listing(request_data, kind, name, mask, user_name=None, user_pass=None, cert=None):
+    # only matched names are kept in memory, whole listing is streamed through fnmatch
+    cache = ListingCache()
+    key = (request_data['context']['repository'], str(user_name), kind, name, mask)
+    matched = cache.lookup(key)
+    if matched is not None:
+        return matched, 200
+    listing, _, code = request_images(request_data, user_name, user_pass, cert) if kind == 'catalog' \
+        else request_tags(request_data, name, user_name, user_pass, cert)
+    if code != 200:
+        return listing, code
+    matched = fnmatch.filter(listing, mask)
+    if listing.error is not None:
+        request_data['errors'].append({name or kind: listing.error})
+    elif listing.complete:
+        cache.store(key, matched)
+    return matched, 200
+
+
+def split_image(image):
+    # name:tag or name@sha256:digest
+    if '@' in image:
+        return image.split('@', 1)
+    image_data = image.rsplit(':', 1)
+    return image_data[0], image_data[1] if len(image_data) > 1 else 'latest'
 
 
 def request_digest(request_data, image, user_name=None, user_pass=None, cert=None):
-    image_data = image.rsplit(':')
+    image_data = split_image(image)
     apiv2_route = '{}://{}/v2/{}/manifests/{}' \
         .format(request_data['context']['repository_schm'], request_data['context']['repository'],
                 image_data[0], image_data[1])
-    response, headers, code = request_apiv2_route(apiv2_route, user_name=user_name, user_pass=user_pass, cert=cert)
-    return (None
-            if code != 200 else (None if 'Docker-Content-Digest' not in headers
-                                 else headers['Docker-Content-Digest'])), 200
+    # HEAD: digest is in headers, manifest body is not needed
+    for method in ('HEAD', 'GET'):
+        response, headers, code = request_apiv2_route(apiv2_route, user_name=user_name, user_pass=user_pass,
+                                                      cert=cert, extra_headers={'Accept': MANIFEST_ACCEPT},
+                                                      method=method)
+        if code == 200 and 'Docker-Content-Digest' in headers:
+            return headers['Docker-Content-Digest'], 200
+    return None, 200
+
+
+def request_manifest(request_data, image, user_name=None, user_pass=None, cert=None, platform=('linux', 'amd64')):
+    image_name, reference = split_image(image)
+    apiv2_route = '{}://{}/v2/{}/manifests/{}' \
+        .format(request_data['context']['repository_schm'], request_data['context']['repository'],
+                image_name, reference)
+    manifest, _, code = request_apiv2_route(apiv2_route, user_name=user_name, user_pass=user_pass, cert=cert,
+                                            extra_headers={'Accept': MANIFEST_ACCEPT})
+    if code != 200:
+        return manifest, code
+    if manifest.get('mediaType') in MANIFEST_LIST_TYPES or 'manifests' in manifest:
+        # multi-arch image: descend to the platform manifest
+        for item in manifest.get('manifests', []):
+            item_platform = item.get('platform', {})
+            if (item_platform.get('os'), item_platform.get('architecture')) == platform:
+                return request_manifest(request_data, f'{image_name}@{item["digest"]}', user_name, user_pass, cert,
+                                        platform)
+        return f'no {"/".join(platform)} manifest for {image}', -1
+    if manifest.get('schemaVersion') != 2 or 'layers' not in manifest:
+        return f'unsupported manifest for {image}', -1
+    return manifest, 0
+
+
+def request_blob(request_data, image_name, digest, user_name=None, user_pass=None, cert=None, offset=0):
+    apiv2_route = '{}://{}/v2/{}/blobs/{}'.format(request_data['context']['repository_schm'],
+                                                 request_data['context']['repository'], image_name, digest)
+    response, _, code = request_apiv2_route(apiv2_route, user_name=user_name, user_pass=user_pass, cert=cert,
+                                            extra_headers={'Range': f'bytes={offset}-'} if offset else None,
+                                            stream=True)
+    return response, 0 if code in (200, 206) else code
+
+
+def download_blob(request_data, image_name, digest, path, user_name=None, user_pass=None, cert=None, size=None):
+    # interrupted transfer is resumed from the partial file with a ranged request
+    chunk_size = int(service_config['COMMON']['KRAS4D_SPOOLCHUNK'])
+    retries = max(1, int(service_config['CONTROL']['KRAS4D_BLOBRETRIES']))
+    part_path = Path(str(path) + '.part')
+    response, code = 'not started', -1
+    for attempt in range(retries):
+        offset = part_path.stat().st_size if part_path.exists() else 0
+        # partial file may already hold the whole blob (e.g. connection dropped right after the last chunk):
+        # it is verified by digest, range beyond the end is refused by registry with 416
+        complete = offset > 0 and size is not None and offset >= int(size)
+        if not complete:
+            response, code = request_blob(request_data, image_name, digest, user_name, user_pass, cert, offset)
+            complete = offset > 0 and code == 416
+        if not complete and code != 0:
+            logging.debug(f'blob {digest}: attempt {attempt + 1} failed with {code} {response}')
+            continue
+        if not complete:
+            try:
+                # registry may ignore the range and send the whole blob
+                with response, open(part_path, 'ab' if response.status_code == 206 else 'wb') as blob_file:
+                    for chunk in response.raw.stream(chunk_size, decode_content=False):
+                        blob_file.write(chunk)
+            except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, OSError) as ex:
+                response, code = str(ex), -1
+                logging.debug(f'blob {digest}: attempt {attempt + 1} interrupted: {ex}')
+                continue
+        blob_digest = file_digest(part_path, digest.split(':', 1)[0], chunk_size)
+        if blob_digest != digest:
+            part_path.unlink()
+            response, code = f'digest mismatch: expected {digest}, received {blob_digest}', -1
+            continue
+        part_path.rename(path)
+        return str(path), 0
+    service_util.soft_remove(part_path)
+    return response, code
+
+
+def file_digest(path, algorithm='sha256', chunk_size=1024 * 1024):
+    try:
+        digest = hashlib.new(algorithm)
+    except ValueError:
+        return None
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(chunk_size), b''):
+            digest.update(chunk)
+    return f'{algorithm}:{digest.hexdigest()}'
 
 
 def create_registry_context(request_string):
@@ -126,34 +468,41 @@ def update_registry_context(context, request_sha256=False, expand_mask=False):
     user_pass = context['context']['credentials']['pass']
     if any(item in name_mask for item in separator):
         name_list.clear()
-        tmp, _, code = request_images(context, user_name=user_name, user_pass=user_pass, cert=verify)
+        tmp, code = filter_listing(context, 'catalog', '', name_mask, user_name, user_pass, verify)
         if code != 200:
             context['errors'].append(tmp)
             return context, code
-        name_list = fnmatch.filter(tmp['repositories'], name_mask)
+        name_list = tmp
     if expand_mask:
         tmp_names = []
         for item in name_list:
             tmp_names.append(item[len(context['context']['image_mask']):])
         name_list = tmp_names
+    workers = max(1, int(service_config['CONTROL']['KRAS4D_REGISTRYWORKERS']))
     if any(item in tags_mask for item in separator):
-        for item in name_list:
-            tag_list, _, code = request_tags(context, item, user_name=user_name, user_pass=user_pass, cert=verify)
-            if code != 200:
-                context['errors'].append({item: tag_list})
-            else:
-                tag_list = fnmatch.filter(tag_list['tags'], tags_mask)
-                for tag in tag_list:
-                    context['images'].update({
-                        '{}:{}'.format(item, tag): ''
-                    })
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='registry-tags') as executor:
+            tag_lists = executor.map(
+                lambda item: filter_listing(context, 'tags', item, tags_mask, user_name, user_pass, verify),
+                name_list)
+            for item, (tag_list, code) in zip(name_list, tag_lists):
+                if code != 200:
+                    context['errors'].append({item: tag_list})
+                else:
+                    for tag in tag_list:
+                        context['images'].update({
+                            '{}:{}'.format(item, tag): ''
+                        })
     else:
         for item in name_list:
             context['images'].update({
                 '{}:{}'.format(item, tags_mask): ''
             })
     if request_sha256:
-        for item in context['images']:
-            sha256, app_code = request_digest(context, item, user_name=user_name, user_pass=user_pass, cert=verify)
-            context['images'].update({item: sha256})
+        images = list(context['images'])
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='registry-digest') as executor:
+            digests = executor.map(
+                lambda item: request_digest(context, item, user_name=user_name, user_pass=user_pass, cert=verify),
+                images)
+            for item, (sha256, app_code) in zip(images, digests):
+                context['images'].update({item: sha256})
     return context, 0
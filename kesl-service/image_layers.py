@@ -0,0 +1,71 @@
+import shutil
+import logging
+import tarfile
+from pathlib import Path, PurePosixPath
+from concurrent.futures import ThreadPoolExecutor
+import service_util
+from configurator import service_config
+from docker_apiv2 import download_blob
+
+UNPACKABLE_LAYER_TYPES = (
+    'application/vnd.docker.image.rootfs.diff.tar.gzip',
+    'application/vnd.oci.image.layer.v1.tar+gzip',
+    'application/vnd.oci.image.layer.v1.tar'
+)
+
+WHITEOUT_PREFIX = '.wh.'
+
+
+def layer_member_path(directory, member_name):
+    parts = [part for part in PurePosixPath(member_name).parts if part not in ('/', '.')]
+    if not parts or '..' in parts or parts[-1].startswith(WHITEOUT_PREFIX):
+        return None
+    return Path(directory).joinpath(*parts)
+
+
+def unpack_layer(blob_path, directory):
+    # only regular files matter for the scanner: links, devices and whiteouts are skipped
+    files_count = 0
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    with tarfile.open(blob_path, mode='r:*') as layer:
+        for member in layer:
+            path = layer_member_path(directory, member.name)
+            if path is None or not member.isfile():
+                continue
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with layer.extractfile(member) as member_data, open(path, 'wb') as member_file:
+                shutil.copyfileobj(member_data, member_file)
+            files_count += 1
+    return files_count
+
+
+def fetch_layer(request_data, image_name, layer, directory, user_name=None, user_pass=None, cert=None):
+    log = logging.getLogger('main.image-layers')
+    if layer.get('mediaType') not in UNPACKABLE_LAYER_TYPES:
+        return f'unsupported layer media type {layer.get("mediaType")}', -1
+    blob_path = Path(str(directory) + '.blob')
+    blob_path.parent.mkdir(parents=True, exist_ok=True)
+    response, code = download_blob(request_data, image_name, layer['digest'], blob_path, user_name, user_pass, cert,
+                                   layer.get('size'))
+    if code != 0:
+        return f'unable to download layer {layer["digest"]}: {response}', code
+    try:
+        files_count = unpack_layer(blob_path, directory)
+    except (tarfile.TarError, OSError, EOFError) as ex:
+        return f'unable to unpack layer {layer["digest"]}: {ex}', -1
+    finally:
+        service_util.soft_remove(blob_path)
+    log.debug(f'layer {layer["digest"]}: {layer.get("size")} bytes, {files_count} files unpacked to {directory}')
+    return files_count, 0
+
+
+def fetch_layers(request_data, image_name, layers, directory, user_name=None, user_pass=None, cert=None):
+    # layers are independent blobs: download and unpack them in parallel
+    workers = max(1, min(len(layers), int(service_config['CONTROL']['KRAS4D_LAYERWORKERS']))) if layers else 1
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='layer') as executor:
+        futures = {
+            digest: executor.submit(fetch_layer, request_data, image_name, layers[digest],
+                                    Path(directory).joinpath(digest.replace(':', '_')), user_name, user_pass, cert)
+            for digest in layers
+        }
+        return {digest: futures[digest].result() for digest in futures}
@@ -0,0 +1,66 @@
+import queue
+import logging
+import threading
+
+
+class PipelineStage:
+
+    def __init__(self, name, handler, workers=1, queue_size=0):
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, int(workers))
+        self.input = queue.Queue(maxsize=max(0, int(queue_size)))
+        self.running = self.workers
+        self.running_mutex = threading.Lock()
+
+
+class ImagePipeline:
+
+    STOP = object()
+
+    def __init__(self, name='pipeline'):
+        self.log = logging.getLogger('main.pipeline')
+        self.name = name
+        self.stages = []
+        self.threads = []
+
+    def add_stage(self, name, handler, workers=1, queue_size=0):
+        self.stages.append(PipelineStage(name, handler, workers, queue_size))
+        return self
+
+    def run(self, items):
+        for index, stage in enumerate(self.stages):
+            for number in range(stage.workers):
+                worker = threading.Thread(target=self.worker_func, args=(index,),
+                                          name=f'{self.name}-{stage.name}-{number}', daemon=True)
+                worker.start()
+                self.threads.append(worker)
+        # feeder: blocks on the first stage bounded queue
+        for item in items:
+            self.stages[0].input.put(item)
+        for _ in range(self.stages[0].workers):
+            self.stages[0].input.put(self.STOP)
+        for worker in self.threads:
+            worker.join()
+
+    def worker_func(self, index):
+        stage = self.stages[index]
+        next_stage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        while True:
+            item = stage.input.get()
+            if item is self.STOP:
+                break
+            try:
+                result = stage.handler(item)
+            except Exception as ex:
+                self.log.error(f'{self.name}: stage {stage.name} failed with exception {str(ex)}', exc_info=True)
+                result = None
+            if result is not None and next_stage is not None:
+                next_stage.input.put(result)
+        with stage.running_mutex:
+            stage.running -= 1
+            last_worker = stage.running == 0
+        # last worker of the stage closes the next one
+        if last_worker and next_stage is not None:
+            for _ in range(next_stage.workers):
+                next_stage.input.put(self.STOP)
@@ -0,0 +1,165 @@
+import json
+import time
+import logging
+import threading
+from configurator import service_config
+from podman_control import PodmanControl
+from service_types import SpecSingleton
+
+
+class ImageStore(metaclass=SpecSingleton):
+    """
+    pulled images are kept in podman storage (keyed by digest) until disk budget is exceeded
+    """
+
+    def __init__(self):
+        self.log = logging.getLogger('main.image-store')
+        self.enabled = bool(service_config['CONTROL']['KRAS4D_IMAGECACHE'])
+        self.budget = int(service_config['CONTROL']['KRAS4D_IMAGECACHESIZE'])
+        self.period = max(1, int(service_config['CONTROL']['KRAS4D_IMAGECACHEPERIOD']))
+        self.mutex = threading.Lock()
+        self.wakeup = threading.Event()
+        # digest -> {'iid', 'size', 'accessed', 'in_use'}
+        self.images = dict()
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.evictor = None
+
+    def final_construct(self):
+        if not self.enabled:
+            return 'disabled', 0
+        response, code = self.rebuild()
+        self.evictor = threading.Thread(target=self.evictor_func, name='image-evictor', daemon=True)
+        self.evictor.start()
+        return response, code
+
+    def rebuild(self):
+        # images left in storage by previous run are cached too
+        images, code = self.list_images()
+        if code != 0:
+            self.log.error(f'unable to list podman images: {images}')
+            return images, code
+        now = time.time()
+        with self.mutex:
+            for image in images:
+                for digest in self.image_digests(image):
+                    self.images.setdefault(digest, {'iid': image['Id'], 'size': image.get('Size', 0),
+                                                    'accessed': image.get('Created', now), 'in_use': 0})
+            self.used = self.storage_size(images)
+        self.log.info(f'image cache: {len(images)} images, {self.used} bytes')
+        return '', 0
+
+    @staticmethod
+    def list_images():
+        response, code = PodmanControl().podman_images()
+        if code != 0:
+            return response, code
+        try:
+            return json.loads(response) if response else [], 0
+        except ValueError as ex:
+            return f'unexpected podman images output: {ex}', -1
+
+    @staticmethod
+    def image_digests(image):
+        digests = {image['Digest']} if image.get('Digest') else set()
+        digests.update(item.split('@', 1)[1] for item in image.get('RepoDigests') or [] if '@' in item)
+        return digests
+
+    @staticmethod
+    def storage_size(images):
+        # shared layers are counted for every image: usage is over-estimated, never under-estimated
+        return sum(image.get('Size', 0) for image in {image['Id']: image for image in images}.values())
+
+    def acquire(self, digest):
+        if not self.enabled or not digest:
+            return None
+        with self.mutex:
+            if digest not in self.images:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.images[digest]['accessed'] = time.time()
+            self.images[digest]['in_use'] += 1
+            return self.images[digest]['iid']
+
+    def add(self, digest, iid):
+        if not self.enabled or not digest:
+            return
+        with self.mutex:
+            image = self.images.setdefault(digest, {'iid': iid, 'size': 0, 'accessed': time.time(), 'in_use': 0})
+            image['iid'], image['accessed'] = iid, time.time()
+            image['in_use'] += 1
+
+    def release(self, digest, iid):
+        if self.enabled and digest:
+            with self.mutex:
+                if digest in self.images:
+                    self.images[digest]['in_use'] -= (1 if self.images[digest]['in_use'] > 0 else 0)
+                    self.images[digest]['accessed'] = time.time()
+            # budget is checked by evictor, not on the scan path
+            self.wakeup.set()
+            return '', 0
+        return PodmanControl().podman_remove(iid)
+
+    def evictor_func(self):
+        while True:
+            self.wakeup.wait(self.period)
+            self.wakeup.clear()
+            try:
+                self.evict()
+            except Exception as ex:
+                self.log.error(f'image cache eviction failed with exception {str(ex)}', exc_info=True)
+
+    def evict(self):
+        images, code = self.list_images()
+        if code != 0:
+            self.log.error(f'unable to list podman images: {images}')
+            return
+        sizes = {image['Id']: image.get('Size', 0) for image in images}
+        with self.mutex:
+            # images removed from storage by somebody else
+            for digest in [digest for digest in self.images
+                           if self.images[digest]['iid'] not in sizes and self.images[digest]['in_use'] == 0]:
+                del self.images[digest]
+            self.used = self.storage_size(images)
+            for digest in self.images:
+                self.images[digest]['size'] = sizes.get(self.images[digest]['iid'], 0)
+            candidates = sorted((image['accessed'], digest) for digest, image in self.images.items())
+        for _, digest in candidates:
+            if self.used <= self.budget:
+                break
+            with self.mutex:
+                if digest not in self.images or self.images[digest]['in_use'] > 0:
+                    continue
+                iid, size = self.images[digest]['iid'], self.images[digest]['size']
+                # one image can be known by several digests
+                if any(image['in_use'] > 0 for image in self.images.values() if image['iid'] == iid):
+                    continue
+                for alias in [alias for alias in self.images if self.images[alias]['iid'] == iid]:
+                    del self.images[alias]
+            response, code = PodmanControl().podman_remove(iid)
+            if code != 0:
+                self.log.warning(f'unable to evict image {iid}: {response}')
+                continue
+            self.log.debug(f'image {digest} ({iid}, {size} bytes) evicted')
+            with self.mutex:
+                self.used -= size
+                self.evicted += 1
+
+    def cache_info(self):
+        if not self.enabled:
+            return {'enabled': False}
+        with self.mutex:
+            requests_count = self.hits + self.misses
+            return {
+                'enabled' : True,
+                'images'  : len({image['iid'] for image in self.images.values()}),
+                'used'    : self.used,
+                'budget'  : self.budget,
+                'hits'    : self.hits,
+                'misses'  : self.misses,
+                'evicted' : self.evicted,
+                'hit_rate': round(self.hits / requests_count, 4) if requests_count else 0.0
+            }
@@ -1,9 +1,13 @@
+import queue
 import shlex
 import logging
+import threading
 import subprocess
 import service_util
 from control import Control
 from configurator import service_config
+from podman_control import PodmanStorage
+from service_types import SpecSingleton
 
 
 class KESLControl(Control):
@@ -14,7 +18,9 @@ class KESLControl(Control):
     COMMAND_SET_SET               = '--set-set {} '
     COMMAND_START_TASK            = '--start-task {} -W'
     COMMAND_START_TASK_RUNTIME    = '/usr/bin/kesl-control --start-task {} -W'
+    COMMAND_STOP_TASK             = '--stop-task {}'
     COMMAND_DELETE_TASK           = '--delete-task {}'
+    COMMAND_GET_TASK_LIST         = '--get-task-list'
     COMMAND_REVOKE                = '--remove-active-key'
     COMMAND_SET_TRACE_LEVEL       = '--set-app-settings TraceLevel={}'
     COMMAND_SETUP_UPDATE_TASK     = '--set-set Update {}'
@@ -41,7 +47,7 @@ class KESLControl(Control):
 
     def enable_disable_podman(self, enable=True):
         enabled = 'Yes' if enable else 'No'
-        command = self.COMMAND_ENABLE_DISABLE_PODMAN.format(enabled, '/var/lib/containers/vfs-storage/')
+        command = self.COMMAND_ENABLE_DISABLE_PODMAN.format(enabled, PodmanStorage().root)
         return self.run_command(command)
 
     def create_task(self, name, scan_type):
@@ -62,93 +68,279 @@ class KESLControl(Control):
         command = self.COMMAND_DELETE_TASK.format(name)
         return self.run_command(command)
 
-    def collect_scan_task_events(self, name):
-        event, response = {}, []
+    def get_task_names(self):
+        response, code = self.run_command(self.COMMAND_GET_TASK_LIST)
+        if code != 0:
+            return response, code
+        names = []
+        for line in response.splitlines():
+            if ':' in line:
+                key, value = line.split(':', 1)
+                if key.strip() == 'Name':
+                    names.append(value.strip())
+        return names, 0
+
+    def stop_task(self, name):
+        command = self.COMMAND_STOP_TASK.format(name)
+        return self.run_command(command)
+
+    def collect_scan_task_events(self, name, callback=None):
+        event, response, stop_requested = {}, [], False
+
+        def emit():
+            # callback returns True to stop the task (events keep coming until task is stopped)
+            nonlocal stop_requested
+            response.append(dict(event))
+            if callback is not None and callback(response[-1]) and not stop_requested:
+                stop_requested = True
+                stop_response, stop_code = self.stop_task(name)
+                self.log.debug(f'stop task {name} requested: {stop_code} {stop_response}')
+
         command = self.COMMAND_START_TASK_RUNTIME.format(name)
         self.log.debug(f'start task: <{command}>')
-        process = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=False, env={})
+        process = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   shell=False, env={})
         while True:
             out_success = process.stdout.readline().decode('utf-8').strip()
             if out_success == '' and (process.poll() is not None):
                 if bool(event):
-                    response.append(dict(event))
-                    # TODO callback(event)
+                    emit()
                 break
-            if out_success != '':
-                if out_success.startswith('EventType'):
-                    if bool(event):
-                        response.append(dict(event))
-                        # TODO callback(event)
-                        event = {}
-                    event['EventType'] = out_success.split('=')[1]
-                else:
-                    if bool(event):
-                        if '=' in out_success:
-                            k, v = out_success.split('=', 1)
-                            event[k] = v
-        if process.returncode != 0:
+            if out_success == '':
+                # empty line closes the event: do not wait for the next one
+                if bool(event):
+                    emit()
+                    event = {}
+            elif out_success.startswith('EventType'):
+                if bool(event):
+                    emit()
+                    event = {}
+                event['EventType'] = out_success.split('=')[1]
+            elif bool(event) and '=' in out_success:
+                k, v = out_success.split('=', 1)
+                event[k] = v
+        if process.returncode != 0 and not stop_requested:
             out_error = process.stderr.readline().decode('utf-8').strip()
             return out_error, process.returncode
         return response, 0
 
-    def complete_scan(self, guid: str, scan_item, scan_type):
-        item_name = next(iter(scan_item))
-        task_name = f"kras4d_{guid.replace('-', '_')}"
-        # create task
-        response, code = self.create_task(task_name, scan_type)
-        if code != 0:
-            self.log.error(f'unable to create {scan_type} task {task_name} with error: {response}')
-            return f'unable to create {scan_type} task {task_name} with error: {response}', -1
+    @staticmethod
+    def match_scan_item(scan_items, file_name):
+        # single item tasks (ContainerScan) report objects inside the image, not the scope path
+        if len(scan_items) == 1:
+            return next(iter(scan_items))
+        for item_name in scan_items:
+            item_path = str(scan_items[item_name])
+            if file_name == item_path or file_name.startswith(item_path.rstrip('/') + '/'):
+                return item_name
+        return None
+
+    def process_scan_events(self, events, scan_items, interrupted=False):
+        task_state = {}
+        item_events = {item_name: {'threats': [], 'errors': []} for item_name in scan_items}
+        for event in events:
+            self.log.debug(f'event:\n{service_util.json_dumps2(event)}')
+            if event['EventType'] == 'TaskStateChanged':
+                if event['TaskState'] == 'Started':
+                    task_state['started'] = service_util.reformat_datetime_string(event['Date'])
+                elif event['TaskState'] == 'Stopped':
+                    task_state['stopped'] = service_util.reformat_datetime_string(event['Date'])
+            elif event['EventType'] in ('ThreatDetected', 'ObjectProcessingError'):
+                item_name = self.match_scan_item(scan_items, event.get('FileName', ''))
+                if item_name is None:
+                    self.log.warning(f'unable to map event object {event.get("FileName")} to scan item')
+                    continue
+                if event['EventType'] == 'ThreatDetected':
+                    item_events[item_name]['threats'].append({
+                        'name': event['DetectName'],
+                        'object': event['FileName']
+                    })
+                else:
+                    item_events[item_name]['errors'].append({
+                        'error': event['ObjectProcessError'] if 'ObjectProcessError' in event else 'generic',
+                        'object': event['FileName']
+                    })
+        results = dict()
+        for item_name in scan_items:
+            scan_result = {'error': [], 'verdict': 'clean'}
+            scan_result.update(task_state)
+            if item_events[item_name]['threats']:
+                scan_result['threats'] = item_events[item_name]['threats']
+                scan_result['verdict'] = 'infected'
+            elif interrupted:
+                # task was stopped before this item was completely scanned
+                scan_result['info'] = 'scan stopped on first threat'
+                scan_result['verdict'] = 'skipped'
+            elif item_events[item_name]['errors']:
+                scan_result['errors'] = item_events[item_name]['errors']
+                scan_result['verdict'] = 'non scanned'
+            if interrupted:
+                scan_result['interrupted'] = True
+            results[item_name] = scan_result
+        return results
+
+    def batch_scan(self, guid: str, scan_items, scan_type='ODS', on_event=None, stop_on_threat=False):
+        task_pool = ScanTaskPool()
+        task_name = task_pool.checkout(scan_type)
+        temporary = task_name is None
+        if temporary:
+            # pool exhausted or not initialized: fallback to one-shot task
+            task_name = f"kras4d_{guid.replace('-', '_')}"
+            task_pool.own(task_name)
+            response, code = self.create_task(task_name, scan_type)
+            if code != 0:
+                task_pool.disown(task_name)
+                self.log.error(f'unable to create {scan_type} task {task_name} with error: {response}')
+                return f'unable to create {scan_type} task {task_name} with error: {response}', -1
         # settings
         settings = {
             'FirstAction': 'Skip',
             'SecondAction': 'Skip'
         }
-        settings.update({'ScanScope.item_0000.Path': scan_item[item_name]} if scan_type == 'ODS'
-                        else {'ImageNameMask': scan_item[item_name]})
-        # settings = {'ScanScope.item_0000.Path': scan_item[item_name]} \
-        #    if scan_type == 'ODS' else {'ImageNameMask': scan_item[item_name]}
-        response, code = self.task_settings(task_name, settings)
+        if scan_type == 'ODS':
+            for index, item_name in enumerate(scan_items):
+                settings.update({f'ScanScope.item_{index:04d}.Path': scan_items[item_name]})
+        else:
+            settings.update({'ImageNameMask': scan_items[next(iter(scan_items))]})
+        response, code = self.task_settings(task_name, settings) if temporary \
+            else task_pool.configure(task_name, settings)
         if code != 0:
-            # TODO delete task
             self.log.error(f'unable to apply settings to {scan_type} task {task_name} with error: {response}')
+            if temporary:
+                self.delete_task(task_name)
+                task_pool.disown(task_name)
+            else:
+                task_pool.checkin(task_name, False)
             return f'unable to apply settings to {scan_type} task {task_name} with error: {response}', -1
         # start scan
-        scan_result = dict()
-        scan_result['error'] = []
-        events, code = self.collect_scan_task_events(task_name)
-        if code == 0:
-            tmp_threats, tmp_errors = [], []
-            scan_result['verdict'] = 'clean'
-            for event in events:
-                self.log.debug(f'event:\n{service_util.json_dumps2(event)}')
-                if event['EventType'] == 'TaskStateChanged':
-                    if event['TaskState'] == 'Started':
-                        scan_result['started'] = service_util.reformat_datetime_string(event['Date'])
-                    elif event['TaskState'] == 'Stopped':
-                        scan_result['stopped'] = service_util.reformat_datetime_string(event['Date'])
-                elif event['EventType'] == 'ThreatDetected':
-                    tmp_threats.append({
-                        'name': event['DetectName'],
-                        'object': event['FileName']
-                    })
-                elif event['EventType'] == 'ObjectProcessingError':
-                    tmp_errors.append({
-                        'error': event['ObjectProcessError'] if 'ObjectProcessError' in event else 'generic',
-                        'object': event['FileName']
-                    })
-            if tmp_threats:
-                scan_result['threats'] = tmp_threats
-                scan_result['verdict'] = 'infected'
-            elif tmp_errors:
-                scan_result['errors'] = tmp_errors
-                scan_result['verdict'] = 'non scanned'
+        threat_detected = False
+
+        def handle_event(event):
+            nonlocal threat_detected
+            item_name = self.match_scan_item(scan_items, event.get('FileName', '')) \
+                if event['EventType'] in ('ThreatDetected', 'ObjectProcessingError', 'ObjectProcessed') else None
+            if on_event is not None:
+                on_event(event, item_name)
+            threat_detected = threat_detected or event['EventType'] == 'ThreatDetected'
+            return stop_on_threat and threat_detected
+
+        events, code = self.collect_scan_task_events(task_name, handle_event)
+        # failed task: raw error is returned for the whole batch, callers wrap it into item results
+        scan_results = self.process_scan_events(events, scan_items, stop_on_threat and threat_detected) \
+            if code == 0 else events
+        if temporary:
+            # delete task
+            response, delete_code = self.delete_task(task_name)
+            task_pool.disown(task_name)
+            if delete_code != 0:
+                self.log.warning(f'unable to delete task {task_name}: {response}')
         else:
-            scan_result['error'].append({
-                'error': events
-            })
-        # delete task
-        response, code = self.delete_task(task_name)
+            task_pool.checkin(task_name, code == 0)
+        return scan_results, code
+
+    def complete_scan(self, guid: str, scan_item, scan_type, on_event=None, stop_on_threat=False):
+        item_name = next(iter(scan_item))
+        scan_results, code = self.batch_scan(guid, scan_item, scan_type, on_event, stop_on_threat)
+        if not isinstance(scan_results, dict):
+            return scan_results, code
+        return scan_results[item_name], code
+
+
+class ScanTaskPool(metaclass=SpecSingleton):
+
+    TASK_PREFIX = 'kras4d_'
+    POOL_PREFIX = 'kras4d_pool_'
+    SCAN_TYPES  = ('ODS', 'ContainerScan')
+
+    def __init__(self):
+        self.log = logging.getLogger('main.task-pool')
+        self.control = KESLControl()
+        self.size = max(1, int(service_config['CONTROL']['KRAS4D_SCANWORKERS']))
+        self.free_tasks = {scan_type: queue.Queue() for scan_type in self.SCAN_TYPES}
+        self.task_types = dict()
+        self.task_settings = dict()
+        self.settings_mutex = threading.Lock()
+        # one-shot tasks of scans running in this process
+        self.owned_tasks = set()
+        self.ready = False
+
+    def final_construct(self):
+        self.reconcile()
+        for scan_type in self.SCAN_TYPES:
+            for index in range(self.size):
+                task_name = f'{self.POOL_PREFIX}{scan_type.lower()}_{index:02d}'
+                self.task_types[task_name] = scan_type
+                if self.create_task(task_name):
+                    self.free_tasks[scan_type].put(task_name)
+        self.ready = True
+        return '', 0
+
+    def reconcile(self):
+        # tasks leaked by a crashed or killed service instance
+        names, code = self.control.get_task_names()
         if code != 0:
-            self.log.warning(f'unable to delete task {task_name}: {response}')
-        return scan_result, code
+            self.log.error(f'unable to get task list: {names}')
+            return
+        for task_name in names:
+            if task_name.startswith(self.TASK_PREFIX) and not self.owned(task_name):
+                response, code = self.control.delete_task(task_name)
+                self.log.info(f'delete leaked task {task_name}: {code} {response}')
+
+    def own(self, task_name):
+        with self.settings_mutex:
+            self.owned_tasks.add(task_name)
+
+    def disown(self, task_name):
+        with self.settings_mutex:
+            self.owned_tasks.discard(task_name)
+
+    def owned(self, task_name):
+        with self.settings_mutex:
+            return task_name in self.owned_tasks
+
+    def create_task(self, task_name):
+        response, code = self.control.create_task(task_name, self.task_types[task_name])
+        with self.settings_mutex:
+            self.task_settings[task_name] = dict()
+        if code != 0:
+            self.log.error(f'unable to create pool task {task_name}: {response}')
+        return code == 0
+
+    def checkout(self, scan_type):
+        if not self.ready or scan_type not in self.free_tasks:
+            return None
+        # scan worker never waits for pool: one-shot task is created by caller instead
+        try:
+            return self.free_tasks[scan_type].get_nowait()
+        except queue.Empty:
+            self.log.debug(f'no free {scan_type} task in pool')
+            return None
+
+    def checkin(self, task_name, healthy=True):
+        if not healthy:
+            # unknown task state: re-create it from scratch
+            self.control.delete_task(task_name)
+            if not self.create_task(task_name):
+                return
+        self.free_tasks[self.task_types[task_name]].put(task_name)
+
+    def configure(self, task_name, settings):
+        with self.settings_mutex:
+            applied = dict(self.task_settings[task_name])
+        required = dict(settings)
+        # scope items left from a bigger batch must be excluded from scan
+        for key in applied:
+            if key.startswith('ScanScope.') and key.endswith('.Path') and key not in settings:
+                required[key[:-len('.Path')] + '.UseScanArea'] = 'No'
+        for key in settings:
+            if key.startswith('ScanScope.') and key.endswith('.Path'):
+                required[key[:-len('.Path')] + '.UseScanArea'] = 'Yes'
+        changed = {key: required[key] for key in required if applied.get(key) != required[key]}
+        if not changed:
+            return '', 0
+        response, code = self.control.task_settings(task_name, changed)
+        if code == 0:
+            applied.update(changed)
+            with self.settings_mutex:
+                self.task_settings[task_name] = applied
+        return response, code
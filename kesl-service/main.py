@@ -7,6 +7,7 @@ import service_types
 from product_info import ProductInfo
 from logger import init_logger
 from application import Application
+from spool import SpoolRequest
 from distutils.dir_util import copy_tree
 from service_util import json_default_decode, json_secure
 from flask import Flask, request, make_response
@@ -20,6 +21,7 @@ from subprocess import check_output
 main_app = Application
 hook_app = Flask('kesl-service')
 hook_app.config['APPLICATION_ROOT'] = '/v1/antivirus'
+hook_app.request_class = SpoolRequest
 
 
 def create_response(message, user_code):
@@ -40,7 +42,9 @@ def main_shutdown():
 def show_status():
     if main_app.auth() is True:
         product_info = ProductInfo()
-        return create_response(product_info.create_product_info(), 200)
+        response = product_info.create_product_info()
+        response.update(main_app.service_info())
+        return create_response(response, 200)
     return create_response(*main_app.make_error(main_app.ERR_FORBIDDEN))
 
 
@@ -73,6 +77,40 @@ def show_scan_id(guid):
     return create_response(user_response, user_code)
 
 
+@hook_app.route('/scans/<string:guid>/events', methods=['GET'])
+def scan_events(guid):
+    response = main_app.scan_events(guid)
+    return create_response(*response) if isinstance(response, tuple) else response
+
+
+@hook_app.route('/watches', methods=['GET'])
+def show_watches():
+    user_response, user_code = main_app.show_watches()
+    return create_response(json.dumps(user_response, default=json_default_decode), user_code)
+
+
+@hook_app.route('/watches', methods=['POST'])
+def add_watch():
+    if not request.content_type or not request.content_type.startswith('application/json'):
+        main_app.log.warning(f'unsupported content type {request.content_type}')
+        return create_response(
+            *main_app.make_error(main_app.ERR_NOT_SUPPORTED_CONTENT_TYPE, details=request.content_type))
+    user_response, user_code = main_app.add_watch()
+    return create_response(user_response, user_code)
+
+
+@hook_app.route('/watches/<string:watch_id>', methods=['GET'])
+def show_watch(watch_id):
+    user_response, user_code = main_app.show_watches(watch_id)
+    return create_response(user_response, user_code)
+
+
+@hook_app.route('/watches/<string:watch_id>', methods=['DELETE'])
+def delete_watch(watch_id):
+    user_response, user_code = main_app.delete_watch(watch_id)
+    return create_response(user_response, user_code)
+
+
 @hook_app.route('/addcert', methods=['POST'])
 def add_certificate():
     if not request.content_type or not request.content_type.startswith(service_types.support_cert_contents):
@@ -95,6 +133,7 @@ def exit_service(signum=None, frame=None):
 
 if __name__ == '__main__':
     get_config()
+    hook_app.config['MAX_CONTENT_LENGTH'] = int(service_config['COMMON']['KRAS4D_MAXBODYSIZE'] or 0) or None
     rotation = None
     if 'KRAS4D_LOGROTATE' in service_config['COMMON'] and service_config['COMMON']['KRAS4D_LOGROTATE'] is not None:
         if 'x' in servive_config['COMMON']['KRAS4D_LOGROTATE']:
@@ -121,6 +160,8 @@ if __name__ == '__main__':
             exit_service()
         # start
         from waitress import serve
-        serve(hook_app, listen='*:{}'.format(service_config['COMMON']['KRAS4D_PORT']))
+        # long-poll and SSE clients hold a thread for the whole wait
+        serve(hook_app, listen='*:{}'.format(service_config['COMMON']['KRAS4D_PORT']),
+              threads=int(service_config['COMMON']['KRAS4D_HTTPTHREADS']))
     except (OSError, ValueError) as ex:
         main_log.error(f'application exception {str(ex)}', exc_info=True)
@@ -7,9 +7,11 @@ class CommonErrorResponse:
     ERR_INVALID_LINK               = (400, 'INVALID_LINK', 'Invalid image url')
     ERR_NOTHING_TO_PROCESS         = (400, 'NOTHING_TO_PROCESS', 'Nothing to process')
     ERR_FORBIDDEN                  = (403, 'FORBIDDEN', 'Forbidden')
+    ERR_BODY_TOO_LARGE             = (413, 'BODY_TOO_LARGE', 'Request body too large')
     ERR_OBJECT_NOT_FOUND           = (404, 'OBJECT NOT FOUND', 'Object not found')
     ERR_INTERNAL_SERVER_ERROR      = (500, 'INTERNAL_SERVER_ERROR', 'Internal server error')
     ERR_INVALID_URL_FORMAT         = (400, 'INVALID_URL_FORMAT', 'Invalid url format')
+    ERR_INVALID_PARAMETER          = (400, 'INVALID_PARAMETER', 'Invalid request parameter')
     ERR_NOT_IMPLEMENTED            = (501, 'NOT IMPLEMENTED', 'Not supported object type')
     ERR_SERVICE_NOT_AVAILABLE      = (503, 'SERVICE NOT AVAILABLE', 'Service not available')
 
@@ -1,6 +1,105 @@
+import re
 import logging
+from pathlib import Path
 from configurator import service_config
 from control import Control
+from service_types import SpecSingleton
+
+
+class PodmanStorage(metaclass=SpecSingleton):
+    """
+    podman storage driver shared by service podman calls and KESL ContainerScan
+    """
+
+    DRIVERS          = ('overlay', 'fuse-overlayfs', 'vfs')
+    DEFAULT_ROOT     = '/var/lib/containers/storage/'
+    STORAGE_CONF     = '/etc/containers/storage.conf'
+    FUSE_OVERLAYFS   = '/usr/bin/fuse-overlayfs'
+    COMMAND_INFO     = 'info --format {{.Store.GraphDriverName}}'
+
+    def __init__(self):
+        self.log = logging.getLogger('main.podman')
+        self.driver = 'vfs'
+        self.detected = False
+
+    def final_construct(self):
+        if service_config['HIDDEN']['KRAS4D_PRVMODE'] is True:
+            return 'default storage', 0
+        requested = str(service_config['COMMON']['KRAS4D_STORAGEDRIVER']).lower()
+        candidates = self.DRIVERS if requested == 'auto' else (requested,)
+        self.detected = False
+        for driver in candidates:
+            if driver not in self.DRIVERS:
+                self.log.error(f'unknown storage driver {driver}')
+                continue
+            response, code = self.probe(driver)
+            if code == 0:
+                self.driver, self.detected = driver, True
+                break
+            self.log.info(f'storage driver {driver} is not available: {response}')
+        if not self.detected:
+            self.log.warning('fallback to vfs storage driver')
+            self.driver = 'vfs'
+        self.log.info(f'podman storage driver: {self.driver}, root: {self.root}')
+        return self.update_storage_conf()
+
+    @staticmethod
+    def driver_name(driver):
+        # fuse-overlayfs is the overlay driver mounted from user space
+        return 'overlay' if driver == 'fuse-overlayfs' else driver
+
+    @property
+    def root(self):
+        if service_config['HIDDEN']['KRAS4D_PRVMODE'] is True:
+            return self.DEFAULT_ROOT
+        return self.driver_root(self.driver)
+
+    def driver_root(self, driver):
+        # drivers can not share one root: images are stored per driver
+        return f'/var/lib/containers/{self.driver_name(driver)}-storage/'
+
+    def options(self, driver=None):
+        if service_config['HIDDEN']['KRAS4D_PRVMODE'] is True:
+            return ''
+        driver = driver if driver else self.driver
+        options = f'--storage-driver {self.driver_name(driver)} --root {self.driver_root(driver)}'
+        if driver == 'fuse-overlayfs':
+            options += f' --storage-opt overlay.mount_program={self.FUSE_OVERLAYFS}'
+        return options
+
+    def probe(self, driver):
+        if driver == 'fuse-overlayfs' and not (Path(self.FUSE_OVERLAYFS).exists() and Path('/dev/fuse').exists()):
+            return 'fuse-overlayfs or /dev/fuse not found', -1
+        response, code = Control(f'/usr/bin/podman {self.options(driver)}').run_command(self.COMMAND_INFO)
+        if code == 0 and response != self.driver_name(driver):
+            return f'podman reports {response} driver', -1
+        return response, code
+
+    def update_storage_conf(self):
+        # KESL runs podman with storage.conf settings: keep them in line with the service
+        try:
+            storage_conf = Path(self.STORAGE_CONF).read_text()
+        except OSError as ex:
+            return f'unable to read {self.STORAGE_CONF}: {ex}', 0
+        storage_conf = re.sub(r'^driver\s*=.*$', f'driver = "{self.driver_name(self.driver)}"', storage_conf,
+                              flags=re.MULTILINE)
+        mount_program = f'mount_program = "{self.FUSE_OVERLAYFS}"'
+        if self.driver == 'fuse-overlayfs':
+            storage_conf = re.sub(r'^#\s*mount_program\s*=.*$', mount_program, storage_conf, flags=re.MULTILINE)
+        else:
+            storage_conf = re.sub(r'^mount_program\s*=.*$', '#' + mount_program, storage_conf, flags=re.MULTILINE)
+        try:
+            Path(self.STORAGE_CONF).write_text(storage_conf)
+        except OSError as ex:
+            return f'unable to update {self.STORAGE_CONF}: {ex}', -1
+        return self.driver, 0
+
+    def storage_info(self):
+        return {
+            'driver'  : self.driver,
+            'root'    : self.root,
+            'detected': self.detected
+        }
 
 
 class PodmanControl(Control):
@@ -9,13 +108,13 @@ class PodmanControl(Control):
     COMMAND_PULL   = 'pull --cert-dir {} --tls-verify={} {}/{}'
     COMMAND_RETAG  = 'tag {} {}'
     COMMAND_PUSH   = 'push --cert-dir {} --tls-verify={} {}'
+    COMMAND_UNTAG  = 'untag {} {}'
     COMMAND_REMOVE = 'rmi {} --force'
+    COMMAND_IMAGES = 'images --format json'
 
     def __init__(self):
         self.log = logging.getLogger('main.podman')
-        init_arg = '/usr/bin/podman' if service_config['HIDDEN']['KRAS4D_PRVMODE'] is True \
-            else '/usr/bin/podman --storage-driver vfs --root /var/lib/containers/vfs-storage/'
-        Control.__init__(self, init_arg)
+        Control.__init__(self, f'/usr/bin/podman {PodmanStorage().options()}'.strip())
 
     def podman_login(self, repository_data):
         host = service_config['REPOSITORIES'][repository_data['repository']] if \
@@ -47,6 +146,13 @@ class PodmanControl(Control):
                                            'true' if tls is True else 'false', image)
         return self.run_command(command)
 
+    def podman_untag(self, image_id, image):
+        command = self.COMMAND_UNTAG.format(image_id, image)
+        return self.run_command(command)
+
     def podman_remove(self, image_id):
         command = self.COMMAND_REMOVE.format(image_id)
         return self.run_command(command)
+
+    def podman_images(self):
+        return self.run_command(self.COMMAND_IMAGES)
@@ -40,6 +40,11 @@ class ProductInfo(Control, metaclass=SpecSingleton):
         with self.__mutex:
             self.__product_restarting_flag = value
 
+    @property
+    def databases_date(self):
+        with self.__mutex:
+            return self.__product_info.databases_date if self.__product_avail_flag else None
+
     def request_product_info(self):
         self.__mutex.acquire()
         try:
@@ -0,0 +1,239 @@
+import json
+import time
+import uuid
+import logging
+import threading
+import validators
+import service_util
+import service_types
+from datetime import datetime
+from configurator import service_config
+from service_types import SpecSingleton
+from docker_apiv2 import create_registry_context, update_registry_context
+
+CREATE_WATCHES_REQUEST = '''
+    CREATE TABLE IF NOT EXISTS watches(
+        watch_id  TEXT PRIMARY KEY,
+        source    TEXT,
+        interval  INTEGER,
+        params    TEXT,
+        origin    TEXT,
+        created   REAL,
+        last_run  REAL,
+        last_scan TEXT,
+        last_error TEXT
+    );
+'''
+
+CREATE_WATCH_INDEX_REQUEST = '''
+    CREATE TABLE IF NOT EXISTS watch_index(
+        watch_id TEXT,
+        image    TEXT,
+        digest   TEXT,
+        seen     REAL,
+        PRIMARY KEY(watch_id, image)
+    );
+'''
+
+WATCH_COLUMNS = ('watch_id', 'source', 'interval', 'params', 'origin', 'created', 'last_run', 'last_scan',
+                 'last_error')
+
+
+class RegistryWatcher(metaclass=SpecSingleton):
+    """
+    polls registry masks and enqueues scans of new or changed digests only
+    """
+
+    POLL_PERIOD = 1
+    CONFIRMED_VERDICTS = ('clean', 'infected')
+
+    def __init__(self):
+        self.log = logging.getLogger('main.registry-watch')
+        self.scan_manager = None
+        self.wakeup = threading.Event()
+        self.watcher = None
+
+    def final_construct(self, scan_manager):
+        self.scan_manager = scan_manager
+        for request in (CREATE_WATCHES_REQUEST, CREATE_WATCH_INDEX_REQUEST):
+            response, code = self.scan_manager.execute_request(request)
+            if code != 0:
+                self.log.error(f'unable to create watch tables: {response}')
+                return response, code
+        # watches from configuration file are re-created on every start
+        for watch in service_config['WATCHES']:
+            response, code = self.add_watch(watch, 'config')
+            if code != 0:
+                self.log.error(f'invalid watch {service_util.json_secure(watch)}: {response}')
+        self.watcher = threading.Thread(target=self.watcher_func, name='registry-watch', daemon=True)
+        self.watcher.start()
+        return '', 0
+
+    @staticmethod
+    def validate(watch):
+        bad_data = []
+        if not isinstance(watch, dict) or not watch.get('source') or not validators.url(watch['source']):
+            bad_data.append({'source': watch.get('source') if isinstance(watch, dict) else watch})
+            return bad_data
+        try:
+            if int(watch.get('interval', service_config['CONTROL']['KRAS4D_WATCHINTERVAL'])) <= 0:
+                bad_data.append({'interval': watch['interval']})
+        except (TypeError, ValueError):
+            bad_data.append({'interval': watch['interval']})
+        if watch.get('params') is not None and not isinstance(watch['params'], dict):
+            bad_data.append({'params': watch['params']})
+        # same checks as for POST /scans: invalid uris would fail every scan of the watch
+        bad_data.extend(service_util.validate_params_urls(watch.get('params')))
+        return bad_data
+
+    def add_watch(self, watch, origin='api'):
+        bad_data = self.validate(watch)
+        if bad_data:
+            return bad_data, -1
+        # same source is watched once: id does not depend on who added it
+        watch_id = str(uuid.uuid5(uuid.NAMESPACE_URL, watch['source']))
+        request = f'''
+            INSERT INTO watches({", ".join(WATCH_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, NULL, NULL, NULL)
+            ON CONFLICT(watch_id) DO UPDATE SET interval = excluded.interval, params = excluded.params,
+            origin = excluded.origin
+        '''
+        response, code = self.scan_manager.execute_request(request, (
+            watch_id, watch['source'], int(watch.get('interval', service_config['CONTROL']['KRAS4D_WATCHINTERVAL'])),
+            json.dumps(watch.get('params'), default=service_util.json_default_decode), origin, time.time()))
+        if code != 0:
+            return response, code
+        self.wakeup.set()
+        return watch_id, 0
+
+    def delete_watch(self, watch_id):
+        watches, code = self.get_watches(watch_id)
+        if code != 0 or not watches:
+            return 'not found', -1
+        response, code = self.scan_manager.execute_request('DELETE FROM watches WHERE watch_id = ?', (watch_id,))
+        if code != 0:
+            return response, code
+        self.scan_manager.execute_request('DELETE FROM watch_index WHERE watch_id = ?', (watch_id,))
+        return watch_id, 0
+
+    def get_watches(self, watch_id=None):
+        request = f'SELECT {", ".join(WATCH_COLUMNS)} FROM watches' + (' WHERE watch_id = ?' if watch_id else '')
+        rows, code = self.scan_manager.execute_request(request, (watch_id,) if watch_id else None)
+        if code != 0:
+            return rows, code
+        watches = []
+        for row in rows:
+            watch = dict(zip(WATCH_COLUMNS, row))
+            watch['params'] = json.loads(watch['params']) if watch['params'] else None
+            watches.append(watch)
+        return watches, 0
+
+    def show_watches(self, watch_id=None):
+        watches, code = self.get_watches(watch_id)
+        if code != 0 or (watch_id and not watches):
+            return watches, -1
+        for watch in watches:
+            watch['source'] = self.secure_source(watch['source'])
+            watch['params'] = service_util.json_secure(watch['params']) if watch['params'] else None
+            for key in ('created', 'last_run'):
+                watch[key] = service_util.reformat_datetime_object(datetime.fromtimestamp(watch[key])) \
+                    if watch[key] else None
+            rows, code = self.scan_manager.execute_request(
+                'SELECT image, digest, seen FROM watch_index WHERE watch_id = ?', (watch['watch_id'],))
+            if code == 0 and watch_id:
+                watch['index'] = {row[0]: row[1] for row in rows}
+            elif code == 0:
+                watch['images'] = len(rows)
+        return watches if not watch_id else watches[0], 0
+
+    @staticmethod
+    def secure_source(source):
+        context, code = create_registry_context(source)
+        if code != 0:
+            return source
+        return f'{context["context"]["repository_schm"]}://{context["context"]["repository"]}' \
+               f'{context["context"]["image_mask"]}'
+
+    def watcher_func(self):
+        while True:
+            self.wakeup.wait(self.POLL_PERIOD)
+            self.wakeup.clear()
+            watches, code = self.get_watches()
+            if code != 0:
+                continue
+            for watch in watches:
+                if watch['last_run'] and watch['last_run'] + watch['interval'] > time.time():
+                    continue
+                try:
+                    self.poll_watch(watch)
+                except Exception as ex:
+                    self.log.error(f'watch {watch["watch_id"]} failed with exception {str(ex)}', exc_info=True)
+                    self.scan_manager.execute_request('UPDATE watches SET last_run = ?, last_error = ? WHERE '
+                                                      'watch_id = ?', (time.time(), str(ex), watch['watch_id']))
+
+    def scan_running(self, guid):
+        # sessions which are not completed are never dropped from sessions cache
+        scan_session = self.scan_manager.scan_sessions_map.get(guid) if guid else None
+        return scan_session is not None and scan_session['scan_summary']['status'] != 'completed'
+
+    def poll_watch(self, watch):
+        if self.scan_running(watch['last_scan']):
+            # digests are confirmed by the running scan: the same images are not enqueued twice
+            self.log.debug(f'watch {watch["watch_id"]}: scan {watch["last_scan"]} is still running')
+            self.scan_manager.execute_request('UPDATE watches SET last_run = ? WHERE watch_id = ?',
+                                              (time.time(), watch['watch_id']))
+            return
+        context, code = create_registry_context(watch['source'])
+        if code == 0:
+            context, code = update_registry_context(context, True)
+        if code != 0:
+            self.log.warning(f'watch {watch["watch_id"]}: unable to list registry: {context}')
+            self.scan_manager.execute_request('UPDATE watches SET last_run = ?, last_error = ? WHERE watch_id = ?', (
+                time.time(), json.dumps(context if isinstance(context, str) else context['errors']),
+                watch['watch_id']))
+            return
+        rows, code = self.scan_manager.execute_request('SELECT image, digest FROM watch_index WHERE watch_id = ?',
+                                                       (watch['watch_id'],))
+        seen = {row[0]: row[1] for row in rows} if code == 0 else {}
+        # image without digest can not be compared: scanned every time
+        changed = {image: digest for image, digest in context['images'].items()
+                   if digest is None or seen.get(image) != digest}
+        self.log.debug(f'watch {watch["watch_id"]}: {len(context["images"])} images, {len(changed)} new or changed')
+        guid = self.enqueue_scan(watch, context, changed) if changed else None
+        now = time.time()
+        self.scan_manager.execute_request(
+            'UPDATE watches SET last_run = ?, last_scan = COALESCE(?, last_scan), last_error = ? WHERE watch_id = ?',
+            (now, guid, json.dumps(context['errors']) if any(context['errors']) else None, watch['watch_id']))
+
+    def scan_completed(self, scan_session):
+        """
+        digests are indexed only when their images got a verdict: failed or skipped images are scanned again
+        """
+        if self.scan_manager is None:
+            return
+        watch_id, items = scan_session['session_info']['watch'], scan_session['session_info']['items']
+        scan_result, now = scan_session['scan_summary']['scan_result'], time.time()
+        confirmed = [(watch_id, image, items[image], now) for image in items if items[image] is not None and
+                     scan_result.get(image, {}).get('verdict') in self.CONFIRMED_VERDICTS]
+        for row in confirmed:
+            self.scan_manager.execute_request(
+                'INSERT OR REPLACE INTO watch_index(watch_id, image, digest, seen) VALUES (?, ?, ?, ?)', row)
+        self.log.debug(f'watch {watch_id}: {len(confirmed)} of {len(items)} images confirmed')
+
+    def enqueue_scan(self, watch, context, images):
+        scan_session = service_types.new_scan_session()
+        scan_session['scan_summary'].update({
+            'status'     : 'created',
+            'created'    : service_util.reformat_datetime_object(datetime.now()),
+            'scan_params': watch['params']
+        })
+        # items are already expanded: scan does not enumerate the registry again
+        scan_session['session_info'].update({
+            'type'  : 'image',
+            'source': watch['source'],
+            'items' : dict(images),
+            'watch' : watch['watch_id']
+        })
+        guid = self.scan_manager.add_scan_request(scan_session)
+        self.scan_manager.async_scan(guid)
+        self.log.info(f'watch {watch["watch_id"]}: scan {guid} enqueued for {len(images)} images')
+        return guid
@@ -0,0 +1,39 @@
+import queue
+import logging
+import threading
+
+
+class ScanEvents:
+
+    SUBSCRIBER_QUEUE_SIZE = 1000
+
+    def __init__(self):
+        self.log = logging.getLogger('main.scan-events')
+        self.condition = threading.Condition()
+        self.subscribers = dict()
+
+    def subscribe(self, guid):
+        subscriber = queue.Queue(maxsize=self.SUBSCRIBER_QUEUE_SIZE)
+        with self.condition:
+            self.subscribers.setdefault(guid, []).append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, guid, subscriber):
+        with self.condition:
+            if guid in self.subscribers and subscriber in self.subscribers[guid]:
+                self.subscribers[guid].remove(subscriber)
+                if not self.subscribers[guid]:
+                    del self.subscribers[guid]
+
+    def publish(self, guid, event_type, data):
+        with self.condition:
+            for subscriber in self.subscribers.get(guid, []):
+                try:
+                    subscriber.put_nowait((event_type, data))
+                except queue.Full:
+                    self.log.warning(f'scan {guid}: slow events subscriber, event {event_type} dropped')
+            self.condition.notify_all()
+
+    def wait_for(self, predicate, timeout):
+        with self.condition:
+            return self.condition.wait_for(predicate, timeout)
@@ -1,18 +1,35 @@
+import json
 import uuid
-import time
+import base64
+import binascii
+import shutil
+import socket
 import tasker
 import logging
-import requests
 import threading
 import service_util
 import service_types
-from string import Template
+from pathlib import Path
 from datetime import datetime
 from db_control import ScansStorage
 from kesl_control import KESLControl
 from configurator import service_config
+from product_info import ProductInfo
+from verdict_cache import VerdictCache
 from podman_control import PodmanControl
-from docker_apiv2 import create_registry_context, update_registry_context
+from image_store import ImageStore
+from image_pipeline import ImagePipeline
+from spool import SpoolManager
+from scan_events import ScanEvents
+from scan_scheduler import ScanScheduler
+from session_cache import SessionCache
+from scans_retention import ScansRetention
+from callback_dispatcher import CallbackDispatcher
+from registry_watch import RegistryWatcher
+from image_layers import fetch_layers
+from docker_apiv2 import create_registry_context, update_registry_context, request_manifest, split_image
+
+SCANS_PAGE_SIZE = 100
 
 
 class CalcProgress:
@@ -20,23 +37,65 @@ class CalcProgress:
     def __init__(self, total):
         self.total = total
         self.current = 0
+        self.mutex = threading.Lock()
 
     def calc(self, current):
         self.current = current
         return int((100 * current)/self.total)
 
     def plus(self, delta):
-        self.current += delta
-        return self.calc(self.current)
+        with self.mutex:
+            return self.calc(self.current + delta)
+
+
+class BatchProgress:
+    """
+    progress of one scan batch: item is counted on its first object event, the rest when batch is finished
+    """
+
+    def __init__(self, progress, items):
+        self.progress = progress
+        self.items = items
+        self.counted = set()
+
+    def object_event(self, item_name):
+        # the last item is never counted by events: batch end is the only reliable completion mark
+        if item_name not in self.items or item_name in self.counted or len(self.counted) >= len(self.items) - 1:
+            return None
+        self.counted.add(item_name)
+        return self.progress.plus(1)
+
+    def finish(self):
+        return self.progress.plus(len(self.items) - len(self.counted))
 
 
 class ScanManager(ScansStorage):
 
     def __init__(self):
-        self.scan_sessions_map = dict()
+        # active and recently used sessions, the rest is read from database on demand
+        self.scan_sessions_map = SessionCache(service_config['CONTROL']['KRAS4D_SESSIONCACHESIZE'])
         self.database_path = None
+        # scans rows up to this version are already applied to sessions cache
+        self.synced_version = 0
+        self.sync_mutex = threading.Lock()
+        self.node_name = socket.gethostname()
         ScansStorage.__init__(self)
         self.log = logging.getLogger('main.scan_mgr')
+        self.scheduler = ScanScheduler(self.run_scan)
+        self.events = ScanEvents()
+        self.file_cache = VerdictCache(self, 'file_verdicts',
+                                       service_config['CONTROL']['KRAS4D_VERDICTCACHE'],
+                                       service_config['CONTROL']['KRAS4D_VERDICTCACHESIZE'],
+                                       service_config['CONTROL']['KRAS4D_VERDICTCACHETTL'])
+        self.image_cache = VerdictCache(self, 'image_verdicts',
+                                        service_config['CONTROL']['KRAS4D_VERDICTCACHE'],
+                                        service_config['CONTROL']['KRAS4D_VERDICTCACHESIZE'],
+                                        service_config['CONTROL']['KRAS4D_VERDICTCACHETTL'])
+        # base layers are shared between images: scanned once, reused by every image built on them
+        self.layer_cache = VerdictCache(self, 'layer_verdicts',
+                                        service_config['CONTROL']['KRAS4D_VERDICTCACHE'],
+                                        service_config['CONTROL']['KRAS4D_VERDICTCACHESIZE'],
+                                        service_config['CONTROL']['KRAS4D_VERDICTCACHETTL'])
 
     def final_construct(self, database_path):
         # init database
@@ -47,11 +106,30 @@ class ScanManager(ScansStorage):
             self.log.error(f'unable to construct database object with error {response}')
         else:
             self.read_database()
+            self.file_cache.final_construct()
+            self.image_cache.final_construct()
+            self.layer_cache.final_construct()
+            CallbackDispatcher().final_construct(self)
+            ScansRetention().final_construct(self)
+        tasker.Tasker().register_scan_pool(self.scheduler)
+        self.scheduler.start()
+        if code == 0:
+            self.restore_queue()
         return response, code
 
+    def restore_queue(self):
+        # re-enqueue scans of this node which were pending or interrupted by service restart
+        for guid in list(self.scan_sessions_map):
+            scan_session = self.scan_sessions_map[guid]
+            if scan_session['scan_summary']['status'] in ('queued', 'running') \
+                    and scan_session['session_info'].get('node') == self.node_name:
+                self.log.info(f'restore {scan_session["scan_summary"]["status"]} scan {guid}')
+                self.async_scan(guid)
+
     def add_scan_request(self, scan_session):
         guid = str(uuid.uuid4())
         scan_session.update({'scan_id': guid})
+        scan_session['session_info'].update({'node': self.node_name})
         self.scan_sessions_map[guid] = scan_session
         response, app_code = self.add_record(guid, scan_session)
         if app_code != 0:
@@ -59,8 +137,14 @@ class ScanManager(ScansStorage):
         return guid
 
     def read_database(self):
-        self.log.debug(f're-read scans database')
-        rows, code = self.db_get_records()
+        # completed scans are loaded on demand by show_scan_id
+        self.log.debug(f're-read active scans from database')
+        # version is taken before rows: rows changed while reading are picked up by next refresh
+        version, code = self.db_get_version()
+        if code != 0:
+            self.log.error(f'unable to read database version with error {version}')
+            return None
+        rows, code = self.db_get_records(('created', 'queued', 'running'))
         if code != 0:
             self.log.error(f'unable to read database with error {rows}')
             return None
@@ -68,35 +152,131 @@ class ScanManager(ScansStorage):
             scan_session = service_types.upload_dict(service_types.scan_session_scheme, row)
             if not scan_session['scan_id'] in self.scan_sessions_map:
                 self.scan_sessions_map[scan_session['scan_id']] = scan_session
+        self.synced_version = version
+
+    def refresh_sessions(self):
+        # only rows written since last refresh (by this or other services sharing database) are read
+        with self.sync_mutex:
+            rows, code = self.db_get_changes(self.synced_version)
+            if code != 0:
+                self.log.error(f'unable to read database changes with error {rows}')
+                return
+            for guid, status, _ in rows:
+                scan_session = self.scan_sessions_map.get(guid)
+                # completed scans which are not cached are loaded on demand
+                if not self.local_session(scan_session) and \
+                        (scan_session is not None or status not in SessionCache.TERMINAL_STATUSES):
+                    self.reload_session(guid)
+            if rows:
+                self.synced_version = rows[-1][2]
+            self.log.debug(f'{len(rows)} changed scans read from database, version {self.synced_version}')
+
+    def local_session(self, scan_session):
+        # sessions created by this service are always up to date in memory
+        return scan_session is not None and scan_session['session_info'].get('node') == self.node_name
+
+    def load_session(self, guid, force=False):
+        scan_session = self.scan_sessions_map.get(guid)
+        if scan_session is not None and (not force or self.local_session(scan_session)):
+            return scan_session
+        return self.reload_session(guid) or scan_session
+
+    def reload_session(self, guid):
+        rows, code = self.db_get_record(guid)
+        if code != 0 or not rows:
+            if code != 0:
+                self.log.error(f'unable to read scan {guid} from database with error {rows}')
+            return None
+        scan_session = service_types.upload_dict(service_types.scan_session_scheme, rows[0])
+        self.scan_sessions_map[guid] = scan_session
+        return scan_session
+
+    @staticmethod
+    def encode_cursor(created, guid):
+        return base64.urlsafe_b64encode(json.dumps([created, guid]).encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            created, guid = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+            return float(created), str(guid)
+        except (ValueError, TypeError, binascii.Error):
+            raise ValueError(f'invalid cursor {cursor}')
 
-    def show_all(self, force: bool):
+    def show_all(self, filters, cursor=None, limit=SCANS_PAGE_SIZE, force=False):
         if force:
-            self.read_database()
-        scans_array = dict()
-        for item in self.scan_sessions_map:
-            scans_array[item] = {
-                'status': self.scan_sessions_map[item]['scan_summary']['status'],
-                'progress': self.scan_sessions_map[item]['scan_summary']['progress']
+            self.refresh_sessions()
+        # page is read from indexed columns, not from sessions map: response size does not grow with history
+        rows, code = self.db_find_records(filters, self.decode_cursor(cursor) if cursor else None, limit)
+        if code != 0:
+            return rows, code
+        scans_array, positions = dict(), self.scheduler.positions()
+        for guid, status, created, completed, progress, verdict, _ in rows:
+            # progress of running scans is not written to database on every item
+            scan_session = self.scan_sessions_map.get(guid)
+            if scan_session is not None:
+                status, progress = scan_session['scan_summary']['status'], scan_session['scan_summary']['progress']
+            scans_array[guid] = {
+                'status'   : status,
+                'progress' : progress,
+                'created'  : created,
+                'completed': completed,
+                'verdict'  : verdict
             }
-        return scans_array
+            if guid in positions:
+                scans_array[guid]['queue_position'] = positions[guid]
+        next_cursor = self.encode_cursor(rows[-1][6], rows[-1][0]) if len(rows) == limit else None
+        return {'scans': scans_array, 'cursor': next_cursor}, 0
 
     def show_scan_id(self, guid, force: bool):
-        if force:
-            self.read_database()
-        if guid in self.scan_sessions_map:
-            return self.scan_sessions_map[guid]['scan_summary'], 0
+        scan_session = self.load_session(guid, force)
+        if scan_session is not None:
+            scan_summary = scan_session['scan_summary']
+            if scan_summary['status'] == 'queued':
+                return dict(scan_summary, queue_position=self.scheduler.position(guid)), 0
+            callbacks = CallbackDispatcher().delivery_state(guid) \
+                if service_util.key_exists(scan_summary, 'scan_params', 'custom_callbacks') else None
+            return dict(scan_summary, callbacks=callbacks) if callbacks else scan_summary, 0
             # return json.dumps(self.scan_sessions_map[guid]['scan_summary'],
             #                  indent=4, default=service_util.json_default_decode), 0
         else:
             return None, -1
 
     def sync_scan(self, guid):
-        # return self.scan_method(guid, True)
-        return self.scan_method(guid, True)
+        scan_summary = self.scan_sessions_map[guid]['scan_summary']
+        job = self.async_scan(guid)
+        job.done.wait()
+        return scan_summary
+
+    def run_scan(self, guid):
+        # session can not be dropped from cache while scan (and its finalization) is running
+        self.scan_sessions_map.pin(guid)
+        try:
+            return self.scan_method(guid)
+        finally:
+            self.scan_sessions_map.unpin(guid)
 
     def async_scan(self, guid):
-        th = threading.Thread(target=self.scan_method, args=(guid,))
-        th.start()
+        scan_summary = self.scan_sessions_map[guid]['scan_summary']
+        priority = scan_summary['scan_params']['priority'] if \
+            service_util.key_exists(scan_summary, 'scan_params', 'priority') else 0
+        self.set_status(guid, 'queued')
+        return self.scheduler.submit(guid, int(priority))
+
+    def set_status(self, guid, status):
+        self.scan_sessions_map[guid]['scan_summary']['status'] = status
+        self.db_full_update(guid, self.scan_sessions_map[guid])
+        self.events.publish(guid, 'status', {'status': status})
+
+    def set_progress(self, guid, progress):
+        self.scan_sessions_map[guid]['scan_summary']['progress'] = progress
+        self.events.publish(guid, 'progress', {'progress': progress})
+
+    def wait_scan_status(self, guid, status, timeout):
+        # long-poll: woken up by change notifications, not by polling
+        return self.events.wait_for(
+            lambda: guid not in self.scan_sessions_map or
+            self.scan_sessions_map[guid]['scan_summary']['status'] == status, timeout)
 
     def append_scan_error(self, guid, code, message, details=None):
         if code != 0:
@@ -105,40 +285,40 @@ class ScanManager(ScansStorage):
                 error_info.update({'details': details})
             self.scan_sessions_map[guid]['scan_summary']['scan_errors'].append(error_info)
 
-    def scan_method(self, guid, sync=False):
-        """
-        todo: check for restart semaphore and add scan thread count
-        """
-        task_interceptor = tasker.Tasker()
-        while task_interceptor.restart_semaphore_state:
-            self.log.debug('restart semaphore detected: wait for restart...')
-            time.sleep(1)
-        task_interceptor.st_inc()
+    def scan_method(self, guid):
+        self.set_status(guid, 'running')
         verdict_list = []
         current_session_info = self.scan_sessions_map[guid]
         skip_exists_image = current_session_info['scan_summary']['scan_params']['skipimageifexists'] if \
             service_util.key_exists(current_session_info, 'scan_summary', 'scan_params', 'skipimageifexists') \
             else service_config['CONTROL']['KRAS4D_SKIPIMAGEIFEXISTS']
         destination_ctx, destination_host, destination_logged = None, None, None
-        pm_control, av_control, name_postfix = PodmanControl(), KESLControl(), 0
+        pm_control, av_control = PodmanControl(), KESLControl()
         if current_session_info['session_info']['type'] == 'image':
             # source login & create context
             response, code = create_registry_context(current_session_info['session_info']['source'])
             if code != 0:
                 self.append_scan_error(guid, code, f'unable to create registry context', response)
+                self.finalize_scan(guid)
                 return self.scan_sessions_map[guid]['scan_summary']
-            response_login, code = pm_control.podman_login(response['context'])
-            if code != 0:
-                self.scan_sessions_map[guid]['scan_summary']['scan_errors'].append(response_login)
-            response, code = update_registry_context(response, skip_exists_image)
-            # TODO: return error
-            self.append_scan_error(guid, code, 'Invalid source', response)
-            self.scan_sessions_map[guid]['scan_summary']['scan_errors'].append(response['errors'])
-            self.scan_sessions_map[guid]['session_info']['items'].update(response['images'])
-            self.scan_sessions_map[guid]['session_info']['context'].update(response['context'])
             destination_host = current_session_info['scan_summary']['scan_params'][
                 'destination'] if service_util.key_exists(current_session_info, 'scan_summary', 'scan_params',
                                                           'destination') else None
+            # layers are fetched over registry API: podman is needed only to push to destination
+            if destination_host or self.image_scan_mode() == 'podman':
+                response_login, code = pm_control.podman_login(response['context'])
+                if code != 0:
+                    self.scan_sessions_map[guid]['scan_summary']['scan_errors'].append(response_login)
+            # items of watch scans are already expanded (with digests) by registry watcher
+            if not current_session_info['session_info']['items']:
+                # image digests are required to skip existing images and to look up cached verdicts and images
+                response, code = update_registry_context(response, skip_exists_image or self.image_cache.enabled
+                                                         or ImageStore().enabled)
+                # TODO: return error
+                self.append_scan_error(guid, code, 'Invalid source', response)
+                self.scan_sessions_map[guid]['scan_summary']['scan_errors'].append(response['errors'])
+                self.scan_sessions_map[guid]['session_info']['items'].update(response['images'])
+            self.scan_sessions_map[guid]['session_info']['context'].update(response['context'])
             if destination_host:
                 destination_ctx, _ = create_registry_context(destination_host)
                 response, code = pm_control.podman_login(destination_ctx['context'])
@@ -154,75 +334,343 @@ class ScanManager(ScansStorage):
             #  print(f'*** DESTINATION:\n{json.dumps(destination_ctx, indent=4)}')
 
         progress = CalcProgress(len(current_session_info['session_info']['items']))
-        for item in current_session_info['session_info']['items']:
-            iid = None
-            name_postfix += 1
-            self.scan_sessions_map[guid]['scan_summary']['progress'] = progress.plus(1)
-            start_date = service_util.reformat_datetime_object(datetime.now())
-
-            if current_session_info['session_info']['type'] == 'stream':
-                scan_info = {item: current_session_info['session_info']['items'][item]}
-                response, code = av_control.complete_scan(f'{guid}_{str(name_postfix)}', scan_info, 'ODS')
-                service_util.soft_remove(scan_info[item])  # Path(scan_info[item]).un link(missing_ok=True)
-            else:
-                response, code = None, 0
-                if skip_exists_image \
-                        and item in destination_ctx['images'] \
-                        and destination_ctx['images'][item] is not None \
-                        and current_session_info['session_info']['items'][item] is not None \
-                        and destination_ctx['images'][item] == current_session_info['session_info']['items'][item]:
-                    response = {
-                        'info': 'image exists and skipped',
-                        'verdict': 'skipped'
-                    }
-                else:
-                    if_tls = current_session_info['session_info']['context']['repository_schm'] == 'https'
-                    iid, code = pm_control.podman_pull(current_session_info['session_info']['context']['repository'],
-                                                       item, if_tls)
-                    if code != 0:
-                        self.append_scan_error(guid, code, f'podman: unable pull image {item}', iid)
-                        continue
-                    self.log.debug(f'start complete scan {item} iid:{iid}')
-                    response, code = av_control.complete_scan(f'{guid}_{str(name_postfix)}', {item: iid},
-                                                              'ContainerScan')
-            stop_date = service_util.reformat_datetime_object(datetime.now())
-            if code == 0:
-                response['started'], response['stopped'] = start_date, stop_date
-            append_data = {item: {'error': response}} if code != 0 else {item: response}
-            verdict_list.append(response['verdict']) if 'verdict' in response else 'error'
-            self.log.debug(f'item {item} verdicts: {verdict_list}')
-            self.scan_sessions_map[guid]['scan_summary']['scan_result'].update(append_data)
-            # TODO:
-            # self.db_update_progress(guid, self.scan_sessions_map[guid])
-            if current_session_info['session_info']['type'] == 'image':
-                if destination_logged is not None and 'verdict' in response and response['verdict'] == 'clean':
-                    stg = f'{current_session_info["session_info"]["context"]["repository"]}/{item}'.replace('//', '/')
-                    dtg = f'{destination_ctx["context"]["repository"]}/' \
-                          f'{destination_ctx["context"]["image_mask"]}/{item}'.replace('//', '/')
-                    response, code = pm_control.podman_retug(stg, dtg)
-                    if code != 0:
-                        self.append_scan_error(guid, code, f'podman: unable re-tag image {stg}: {dtg}', response)
-                    else:
-                        if_tls = destination_ctx['context']['repository_schm'] == 'https'
-                        response, code = pm_control.podman_push(dtg, if_tls)
-                        self.append_scan_error(guid, code, f'podman: unable push image {dtg}', response)
-                response, code = pm_control.podman_remove(iid)
-                self.append_scan_error(guid, code, f'podman: unable to delete image {item}', response)
+        if current_session_info['session_info']['type'] == 'stream':
+            self.scan_stream_items(guid, av_control, progress, verdict_list)
+        else:
+            prefetch = max(1, int(service_config['CONTROL']['KRAS4D_PREFETCHIMAGES']))
+            scan_mode = self.image_scan_mode()
+            session_ctx = {
+                'guid'              : guid,
+                'pm_control'        : pm_control,
+                'av_control'        : av_control,
+                'destination_ctx'   : destination_ctx,
+                'destination_logged': destination_logged,
+                'skip_exists_image' : skip_exists_image,
+                'scan_mode'         : scan_mode,
+                'db_release'        : self.cache_release()
+                if self.image_cache.enabled or self.layer_cache.enabled else None,
+                'scan_options'      : self.cache_options('ContainerScan' if scan_mode == 'podman' else 'Layers'),
+                'layer_options'     : self.cache_options('ODS'),
+                'progress'          : progress,
+                'verdict_list'      : verdict_list,
+                'stop_on_threat'    : self.stop_on_threat_requested(guid),
+                'stop_scan'         : threading.Event(),
+                # disk budget: pulled but not yet scanned images
+                'disk_slots'        : threading.BoundedSemaphore(prefetch)
+            }
+            # pull -> scan -> push stages overlap network, cpu and disk
+            pipeline = ImagePipeline(f'image-{guid[:8]}')
+            pipeline.add_stage('pull', self.image_pull_stage,
+                               service_config['CONTROL']['KRAS4D_PULLWORKERS'], prefetch)
+            pipeline.add_stage('scan', self.image_scan_stage,
+                               service_config['CONTROL']['KRAS4D_SCANSTAGEWORKERS'], prefetch)
+            pipeline.add_stage('push', self.image_push_stage,
+                               service_config['CONTROL']['KRAS4D_PUSHWORKERS'], prefetch)
+            pipeline.run({
+                'session'   : session_ctx,
+                'item'      : item,
+                'number'    : number,
+                'iid'       : None,
+                'slot'      : False,
+                'response'  : None,
+                'code'      : 0,
+                'start_date': None
+            } for number, item in enumerate(current_session_info['session_info']['items'], 1))
         # self.scan_sessions_map[guid]['scan_summary'] = remove_empty(self.scan_sessions_map[guid]['scan_summary'])
         self.scan_sessions_map[guid]['scan_summary']['verdicts'] = list(dict.fromkeys(verdict_list))
         self.finalize_scan(guid)
-        """
-        todo: decrease scan threads count 
-        """
-        task_interceptor.st_dec()
-        if sync:
-            return self.scan_sessions_map[guid]['scan_summary']
+        return self.scan_sessions_map[guid]['scan_summary']
+
+    def image_pull_stage(self, item_ctx):
+        session_ctx, item = item_ctx['session'], item_ctx['item']
+        guid, destination_ctx = session_ctx['guid'], session_ctx['destination_ctx']
+        session_info = self.scan_sessions_map[guid]['session_info']
+        item_ctx['start_date'] = service_util.reformat_datetime_object(datetime.now())
+        if session_ctx['skip_exists_image'] \
+                and destination_ctx is not None \
+                and item in destination_ctx['images'] \
+                and destination_ctx['images'][item] is not None \
+                and session_info['items'][item] is not None \
+                and destination_ctx['images'][item] == session_info['items'][item]:
+            item_ctx['response'] = {
+                'info': 'image exists and skipped',
+                'verdict': 'skipped'
+            }
+            return item_ctx
+        if session_ctx['stop_scan'].is_set():
+            item_ctx['response'] = self.stopped_response()
+            return item_ctx
+        item_ctx['response'] = self.image_cache.lookup(session_info['items'][item], session_ctx['db_release'],
+                                                       session_ctx['scan_options'])
+        if session_ctx['stop_on_threat'] and item_ctx['response'] and item_ctx['response']['verdict'] == 'infected':
+            session_ctx['stop_scan'].set()
+        # layers are fetched by the scan stage, image is pulled only to be pushed to destination
+        if session_ctx['scan_mode'] == 'layers':
+            return item_ctx
+        # clean image still has to be pulled to be pushed to destination
+        if item_ctx['response'] is None or \
+                (session_ctx['destination_logged'] is not None and item_ctx['response']['verdict'] == 'clean'):
+            session_ctx['disk_slots'].acquire()
+            item_ctx['slot'] = True
+            if not self.podman_pull_item(item_ctx):
+                session_ctx['disk_slots'].release()
+                self.set_progress(guid, session_ctx['progress'].plus(1))
+                return None
+        return item_ctx
+
+    def podman_pull_item(self, item_ctx):
+        session_ctx, item = item_ctx['session'], item_ctx['item']
+        session_info = self.scan_sessions_map[session_ctx['guid']]['session_info']
+        iid = ImageStore().acquire(session_info['items'][item])
+        if iid:
+            self.log.debug(f'image {item} found in local storage: {iid}')
+            item_ctx['iid'] = iid
+            return True
+        if_tls = session_info['context']['repository_schm'] == 'https'
+        iid, code = session_ctx['pm_control'].podman_pull(session_info['context']['repository'], item, if_tls)
+        if code != 0:
+            self.append_scan_error(session_ctx['guid'], code, f'podman: unable pull image {item}', iid)
+            return False
+        ImageStore().add(session_info['items'][item], iid)
+        item_ctx['iid'] = iid
+        return True
+
+    def image_scan_stage(self, item_ctx):
+        session_ctx, item = item_ctx['session'], item_ctx['item']
+        guid = session_ctx['guid']
+        try:
+            if item_ctx['response'] is None and session_ctx['stop_scan'].is_set():
+                item_ctx['response'] = self.stopped_response()
+            elif item_ctx['response'] is None and session_ctx['scan_mode'] == 'layers':
+                response, code = self.scan_image_layers(item_ctx)
+                if code == 0:
+                    self.image_cache.store(self.scan_sessions_map[guid]['session_info']['items'][item],
+                                           session_ctx['db_release'], session_ctx['scan_options'], response)
+                item_ctx['response'], item_ctx['code'] = response, code
+            elif item_ctx['response'] is None:
+                self.log.debug(f'start complete scan {item} iid:{item_ctx["iid"]}')
+                response, code = session_ctx['av_control'].complete_scan(
+                    f'{guid}_{str(item_ctx["number"])}', {item: item_ctx['iid']}, 'ContainerScan',
+                    self.scan_event_handler(guid, session_ctx['stop_scan'] if session_ctx['stop_on_threat'] else None),
+                    session_ctx['stop_on_threat'])
+                if code == 0:
+                    self.image_cache.store(self.scan_sessions_map[guid]['session_info']['items'][item],
+                                           session_ctx['db_release'], session_ctx['scan_options'], response)
+                item_ctx['response'], item_ctx['code'] = response, code
+            elif item_ctx['response'].get('cached'):
+                self.log.debug(f'image {item} verdict found in cache')
+        finally:
+            if item_ctx['slot']:
+                item_ctx['slot'] = False
+                session_ctx['disk_slots'].release()
+        self.store_item_result(guid, item, item_ctx['response'], item_ctx['code'], item_ctx['start_date'],
+                               session_ctx['verdict_list'])
+        self.set_progress(guid, session_ctx['progress'].plus(1))
+        return item_ctx
+
+    def image_push_stage(self, item_ctx):
+        session_ctx, item, iid, response = item_ctx['session'], item_ctx['item'], item_ctx['iid'], item_ctx['response']
+        guid, destination_ctx = session_ctx['guid'], session_ctx['destination_ctx']
+        pm_control = session_ctx['pm_control']
+        session_info = self.scan_sessions_map[guid]['session_info']
+        if session_ctx['destination_logged'] is not None and not iid and session_ctx['scan_mode'] == 'layers' \
+                and 'verdict' in response and response['verdict'] == 'clean' and self.podman_pull_item(item_ctx):
+            iid = item_ctx['iid']
+        if session_ctx['destination_logged'] is not None and iid \
+                and 'verdict' in response and response['verdict'] == 'clean':
+            dtg = f'{destination_ctx["context"]["repository"]}/' \
+                  f'{destination_ctx["context"]["image_mask"]}/{item}'.replace('//', '/')
+            # cached image may be tagged with another name: re-tag by id
+            response, code = pm_control.podman_retug(iid, dtg)
+            if code != 0:
+                self.append_scan_error(guid, code, f'podman: unable re-tag image {item}: {dtg}', response)
+            else:
+                if_tls = destination_ctx['context']['repository_schm'] == 'https'
+                response, code = pm_control.podman_push(dtg, if_tls)
+                self.append_scan_error(guid, code, f'podman: unable push image {dtg}', response)
+                if ImageStore().enabled:
+                    pm_control.podman_untag(iid, dtg)
+        if iid:
+            # kept in local storage for the next scans of the same digest, evicted by budget
+            response, code = ImageStore().release(session_info['items'][item], iid)
+            self.append_scan_error(guid, code, f'podman: unable to delete image {item}', response)
+        return None
+
+    def scan_image_layers(self, item_ctx):
+        session_ctx, item = item_ctx['session'], item_ctx['item']
+        guid, av_control = session_ctx['guid'], session_ctx['av_control']
+        session_info = self.scan_sessions_map[guid]['session_info']
+        credentials = session_info['context']['credentials']
+        verify = session_info['context']['repository_schm'] == 'https'
+        manifest, code = request_manifest(session_info, item, credentials['user'], credentials['pass'], verify)
+        if code != 0:
+            return f'unable to get manifest of image {item}: {manifest}', code
+        layers = {layer['digest']: layer for layer in manifest['layers']}
+        layer_results, scan_items = dict(), dict()
+        layers_path = Path(service_config['COMMON']['KRAS4D_TMPPATH']).joinpath(f'layers/{guid}_{item_ctx["number"]}')
+        try:
+            for digest in layers:
+                layer_results[digest] = self.layer_cache.lookup(digest, session_ctx['db_release'],
+                                                                session_ctx['layer_options'])
+            missing = {digest: layers[digest] for digest in layers if layer_results[digest] is None}
+            fetched = fetch_layers(session_info, split_image(item)[0], missing, layers_path,
+                                   credentials['user'], credentials['pass'], verify)
+            for digest in fetched:
+                response, code = fetched[digest]
+                if code != 0:
+                    self.log.warning(f'image {item}: {response}')
+                    layer_results[digest] = {'error': [{'error': response}], 'verdict': 'non scanned'}
+                else:
+                    scan_items[digest] = str(layers_path.joinpath(digest.replace(':', '_')))
+            self.log.debug(f'image {item}: {len(layers) - len(scan_items)} of {len(layers)} layers not scanned')
+            if scan_items:
+                # partial results are reported for the image, not for the layer
+                on_event = self.scan_event_handler(guid, session_ctx['stop_scan']
+                                                   if session_ctx['stop_on_threat'] else None)
+                responses, code = av_control.batch_scan(f'{guid}_{str(item_ctx["number"])}', scan_items, 'ODS',
+                                                        lambda event, _: on_event(event, item),
+                                                        session_ctx['stop_on_threat'])
+                if code != 0:
+                    return responses, code
+                for digest in scan_items:
+                    self.layer_cache.store(digest, session_ctx['db_release'], session_ctx['layer_options'],
+                                           responses[digest])
+                    layer_results[digest] = responses[digest]
+        finally:
+            shutil.rmtree(layers_path, ignore_errors=True)
+        return self.merge_layer_results(session_info['items'][item], manifest, layer_results), 0
+
+    @staticmethod
+    def merge_layer_results(image_digest, manifest, layer_results):
+        response = {'error': [], 'verdict': 'clean', 'image_digest': image_digest,
+                    'config_digest': manifest['config']['digest'], 'layers': {}}
+        for digest in layer_results:
+            layer_result = layer_results[digest]
+            response['layers'][digest] = {
+                'verdict': layer_result['verdict'],
+                'cached': bool(layer_result.get('cached'))
+            }
+            for threat in layer_result.get('threats', []):
+                response.setdefault('threats', []).append(dict(threat, layer=digest))
+            response['error'].extend(layer_result.get('error', []))
+            if layer_result.get('interrupted'):
+                response['interrupted'] = True
+        verdicts = [response['layers'][digest]['verdict'] for digest in response['layers']]
+        for verdict in ('infected', 'skipped', 'non scanned'):
+            if verdict in verdicts:
+                response['verdict'] = verdict
+                break
+        return response
+
+    @staticmethod
+    def image_scan_mode():
+        scan_mode = str(service_config['CONTROL']['KRAS4D_IMAGESCANMODE']).lower()
+        return scan_mode if scan_mode in ('podman', 'layers') else 'podman'
+
+    def store_item_result(self, guid, item, response, code, start_date, verdict_list):
+        stop_date = service_util.reformat_datetime_object(datetime.now())
+        if code == 0:
+            response['started'], response['stopped'] = start_date, stop_date
+        append_data = {item: {'error': response}} if code != 0 else {item: response}
+        verdict_list.append(response['verdict']) if 'verdict' in response else 'error'
+        self.log.debug(f'item {item} verdicts: {verdict_list}')
+        self.scan_sessions_map[guid]['scan_summary']['scan_result'].update(append_data)
+        self.events.publish(guid, 'item', append_data)
+        # on_detect is sent for every infected item as soon as its verdict is known
+        if code == 0 and response.get('verdict') == 'infected' and service_util.key_exists(
+                self.scan_sessions_map[guid], 'scan_summary', 'scan_params', 'custom_callbacks', 'on_detect'):
+            self.enqueue_callback(guid, 'on_detect', {'$infected': {item: response}, '$clean': {}, '$skipped': {}})
+
+    @staticmethod
+    def cache_release():
+        # verdicts are valid only for the antivirus databases release they were produced with
+        product_info = ProductInfo()
+        product_info.request_product_info()
+        return product_info.databases_date
+
+    @staticmethod
+    def cache_options(scan_type):
+        return f'{scan_type};{service_config["CONTROL"]["KRAS4D_SCANOPTIONS"]}'
+
+    def scan_stream_items(self, guid, av_control, progress, verdict_list):
+        items = self.scan_sessions_map[guid]['session_info']['items']
+        hashes = self.scan_sessions_map[guid]['session_info'].get('hashes', {})
+        db_release = self.cache_release() if self.file_cache.enabled else None
+        scan_options = self.cache_options('ODS')
+        stop_on_threat, stop_scan = self.stop_on_threat_requested(guid), threading.Event()
+        names = []
+        for item in items:
+            start_date = service_util.reformat_datetime_object(datetime.now())
+            response = self.file_cache.lookup(hashes.get(item), db_release, scan_options)
+            if response is None:
+                names.append(item)
+                continue
+            self.log.debug(f'item {item} verdict found in cache')
+            if stop_on_threat and response['verdict'] == 'infected':
+                stop_scan.set()
+            SpoolManager().release(items[item])
+            self.store_item_result(guid, item, response, 0, start_date, verdict_list)
+            self.set_progress(guid, progress.plus(1))
+        # several uploaded files share one ODS task, verdicts are mapped back by object path
+        batch_size = max(1, int(service_config['CONTROL']['KRAS4D_SCANBATCHSIZE']))
+        for batch_number, offset in enumerate(range(0, len(names), batch_size), 1):
+            scan_items = {item: items[item] for item in names[offset:offset + batch_size]}
+            start_date = service_util.reformat_datetime_object(datetime.now())
+            batch_progress = BatchProgress(progress, scan_items)
+            if stop_scan.is_set():
+                responses, code = {item: self.stopped_response() for item in scan_items}, 0
+            else:
+                responses, code = av_control.batch_scan(f'{guid}_{str(batch_number)}', scan_items, 'ODS',
+                                                        self.scan_event_handler(guid, stop_scan if stop_on_threat
+                                                                                else None, batch_progress),
+                                                        stop_on_threat)
+            for item in scan_items:
+                SpoolManager().release(scan_items[item])
+                response = responses[item] if isinstance(responses, dict) else responses
+                if code == 0:
+                    self.file_cache.store(hashes.get(item), db_release, scan_options, response)
+                self.store_item_result(guid, item, response, code, start_date, verdict_list)
+            self.set_progress(guid, batch_progress.finish())
+
+    def stop_on_threat_requested(self, guid):
+        scan_summary = self.scan_sessions_map[guid]['scan_summary']
+        return service_util.key_exists(scan_summary, 'scan_params', 'stop_on_first_threat') and \
+            bool(scan_summary['scan_params']['stop_on_first_threat'])
+
+    @staticmethod
+    def stopped_response():
+        return {
+            'info': 'scan stopped on first threat',
+            'verdict': 'skipped'
+        }
+
+    def scan_event_handler(self, guid, stop_scan=None, batch_progress=None):
+        scan_result = self.scan_sessions_map[guid]['scan_summary']['scan_result']
+
+        def on_event(event, item_name):
+            if batch_progress is not None and item_name is not None:
+                progress = batch_progress.object_event(item_name)
+                if progress is not None:
+                    self.set_progress(guid, progress)
+            # partial result is visible while the task is running, final result replaces it
+            if event['EventType'] == 'ThreatDetected':
+                if stop_scan is not None:
+                    stop_scan.set()
+                if item_name is not None:
+                    partial = scan_result.setdefault(item_name, {'verdict': 'infected', 'partial': True})
+                    partial.setdefault('threats', []).append({
+                        'name': event.get('DetectName'),
+                        'object': event.get('FileName')
+                    })
+                    self.events.publish(guid, 'item', {item_name: partial})
+        return on_event
 
     def finalize_scan(self, guid):
-        self.scan_sessions_map[guid]['scan_summary']['status'] = 'completed'
         self.scan_sessions_map[guid]['scan_summary']['completed'] = \
             service_util.reformat_datetime_object(datetime.now())
-        self.db_full_update(guid, self.scan_sessions_map[guid])
+        self.set_status(guid, 'completed')
+        if self.scan_sessions_map[guid]['session_info'].get('watch'):
+            RegistryWatcher().scan_completed(self.scan_sessions_map[guid])
         if service_util.key_exists(self.scan_sessions_map[guid], 'scan_summary', 'scan_params', 'custom_callbacks'):
             short = self.scan_sessions_map[guid]['scan_summary']['scan_result']
             subst = {
@@ -234,46 +682,17 @@ class ScanManager(ScansStorage):
                              in short[item] and short[item]['verdict'] == 'skipped'}
             }
             for clbk in self.scan_sessions_map[guid]['scan_summary']['scan_params']['custom_callbacks']:
-                response, code = self.send_clbk(
-                    self.scan_sessions_map[guid]['scan_summary']['scan_params']['custom_callbacks'][clbk], subst)
-                if code != 0:
-                    self.scan_sessions_map[guid]['scan_summary']['scan_errors'].append({
-                        'code': '-1',
-                        'error': 'unable to send callback',
-                        'details': response
-                    })
+                # on_detect callbacks are already sent by store_item_result
+                if clbk != 'on_detect':
+                    self.enqueue_callback(guid, clbk, subst)
 
-    def json_replace(self, json_data, subst_data, result_data):
-        for k in json_data:
-            v = json_data[k]
-            if isinstance(v, dict):
-                result_data[k] = {}
-                self.json_replace(v, subst_data, result_data)
-            else:
-                result_data[k] = subst_data[json_data[k]] \
-                    if json_data[k].startswith('$') and json_data[k] in subst_data else v
-        return result_data
-
-    def send_clbk(self, clbk, subst):
-        body = {}
-        head = {'content-type': 'application/json'}
-        if 'body' in clbk:
-            if 'content-type' in clbk:
-                if clbk['content-type'] == 'application/json':
-                    result_data = self.json_replace(clbk['body'], subst, {})
-                    body.update(result_data)
-                elif clbk['content-type'] == 'text/plain':
-                    result_data = (Template(clbk['body'])).substitute(subst)  # TODO: '$'
-                    body.update(result_data)
-                else:
-                    body.update(clbk['body'])
-        else:
-            body = None
-        try:
-            response = requests.post(clbk['uri'], headers=head, json=body, timeout=2)
-            if response.status_code != 200:
-                self.log.warning(f'callback error: {response.status_code} {response.reason}')
-            return '', 0
-        except requests.exceptions.RequestException as ex:
-            self.log.debug(f'callback error: {str(ex)}')
-            return str(ex), -1
+    def enqueue_callback(self, guid, clbk, subst):
+        # callbacks are delivered by dispatcher workers: scan worker does not wait for receivers
+        callbacks = self.scan_sessions_map[guid]['scan_summary']['scan_params']['custom_callbacks']
+        response, code = CallbackDispatcher().enqueue(guid, clbk, callbacks[clbk], subst)
+        if code != 0:
+            self.scan_sessions_map[guid]['scan_summary']['scan_errors'].append({
+                'code': '-1',
+                'error': 'unable to send callback',
+                'details': response
+            })
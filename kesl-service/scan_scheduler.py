@@ -0,0 +1,95 @@
+import time
+import queue
+import logging
+import itertools
+import threading
+import tasker
+from configurator import service_config
+
+
+class ScanJob:
+
+    def __init__(self, guid, priority=0):
+        self.guid = guid
+        self.priority = priority
+        self.result = None
+        self.done = threading.Event()
+
+
+class ScanScheduler:
+
+    def __init__(self, handler, workers=None):
+        self.log = logging.getLogger('main.scheduler')
+        self.handler = handler
+        self.workers_count = max(1, int(workers if workers else service_config['CONTROL']['KRAS4D_SCANWORKERS']))
+        self.workers = []
+        self.jobs = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        # pool accounting
+        self.active = 0
+        self.active_mutex = threading.Lock()
+
+    def start(self):
+        for index in range(self.workers_count):
+            worker = threading.Thread(target=self.worker_func, name=f'scan-{index}', daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        self.log.debug(f'scan pool started with {self.workers_count} workers')
+
+    def submit(self, guid, priority=0):
+        job = ScanJob(guid, priority)
+        # higher priority first, FIFO inside the same priority
+        self.jobs.put((-priority, next(self.sequence), job))
+        self.log.debug(f'scan {guid} queued with priority {priority}, pending: {self.jobs.qsize()}')
+        return job
+
+    def positions(self):
+        with self.jobs.mutex:
+            pending = sorted(self.jobs.queue, key=lambda entry: (entry[0], entry[1]))
+        return {entry[2].guid: index + 1 for index, entry in enumerate(pending)}
+
+    def position(self, guid):
+        return self.positions().get(guid)
+
+    @property
+    def active_count(self):
+        with self.active_mutex:
+            return self.active
+
+    @property
+    def pending_count(self):
+        return self.jobs.qsize()
+
+    def pool_info(self):
+        return {
+            'workers': self.workers_count,
+            'active' : self.active_count,
+            'queued' : self.pending_count
+        }
+
+    def acquire_slot(self, task_interceptor):
+        while True:
+            with self.active_mutex:
+                if not task_interceptor.restart_semaphore_state:
+                    self.active += 1
+                    return
+            self.log.debug('restart semaphore detected: wait for restart...')
+            time.sleep(1)
+
+    def release_slot(self):
+        with self.active_mutex:
+            self.active -= (1 if self.active > 0 else 0)
+
+    def worker_func(self):
+        task_interceptor = tasker.Tasker()
+        while True:
+            _, _, job = self.jobs.get()
+            self.acquire_slot(task_interceptor)
+            try:
+                job.result = self.handler(job.guid)
+            except Exception as ex:
+                self.log.error(f'scan {job.guid} failed with exception {str(ex)}', exc_info=True)
+            finally:
+                self.release_slot()
+                job.done.set()
+                self.jobs.task_done()
@@ -0,0 +1,200 @@
+import os
+import gzip
+import json
+import time
+import logging
+import threading
+import service_util
+import service_types
+from pathlib import Path
+from datetime import datetime, timedelta
+from db_control import compact_json
+from configurator import service_config
+from service_types import SpecSingleton
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+class ArchiveWriter:
+    """
+    expired scans as gzip compressed NDJSON segments: one scan session per line
+    """
+
+    def __init__(self, directory, segment_size):
+        self.directory = Path(directory)
+        self.segment_size = int(segment_size)
+        self.file = None
+        self.path = None
+        self.written = 0
+        self.segments = 0
+
+    def write(self, line):
+        if self.file is None or self.written >= self.segment_size:
+            self.rotate()
+        data = (line + '\n').encode('utf-8')
+        self.file.write(data)
+        self.written += len(data)
+
+    def rotate(self):
+        self.close()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.path = self.directory.joinpath(f'scans-{datetime.now().strftime("%Y%m%dT%H%M%S%f")}.ndjson.gz')
+        self.file = gzip.open(self.path, 'wb')
+        self.written = 0
+        self.segments += 1
+
+    def flush(self):
+        # rows are deleted only after they are on disk
+        if self.file is not None:
+            self.file.flush()
+            self.file.fileobj.flush()
+            os.fsync(self.file.fileobj.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class ScansRetention(metaclass=SpecSingleton):
+    """
+    removes (and optionally archives) expired completed scans in small batches, reclaims free pages on schedule
+    """
+
+    BATCH_PAUSE = 0.05
+
+    def __init__(self):
+        self.log = logging.getLogger('main.retention')
+        self.scan_manager = None
+        self.days = float(service_config['COMMON']['KRAS4D_RETENTIONDAYS'] or 0)
+        self.keep_count = int(service_config['COMMON']['KRAS4D_RETENTIONCOUNT'] or 0)
+        self.batch = max(1, int(service_config['COMMON']['KRAS4D_RETENTIONBATCH']))
+        self.period = max(1, int(service_config['COMMON']['KRAS4D_RETENTIONPERIOD']))
+        self.vacuum_period = int(service_config['COMMON']['KRAS4D_VACUUMPERIOD'] or 0)
+        self.vacuum_full = bool(service_config['COMMON']['KRAS4D_VACUUMFULL'])
+        self.archive_path = service_config['COMMON']['KRAS4D_ARCHIVEPATH']
+        self.segment_size = int(service_config['COMMON']['KRAS4D_ARCHIVESEGMENTSIZE'])
+        self.compacted = False
+        self.last_vacuum = time.time()
+        self.purged = 0
+        self.archived = 0
+        self.segments = 0
+        self.last_run = None
+        self.thread = None
+
+    def final_construct(self, scan_manager):
+        self.scan_manager = scan_manager
+        if self.vacuum_full:
+            # before scans are restored and served: full VACUUM blocks every database write while it runs
+            self.switch_auto_vacuum()
+        self.thread = threading.Thread(target=self.retention_func, name='scans-retention', daemon=True)
+        self.thread.start()
+        return '', 0
+
+    def retention_func(self):
+        while True:
+            try:
+                self.run()
+            except Exception as ex:
+                self.log.error(f'scans retention failed with exception {str(ex)}', exc_info=True)
+            time.sleep(self.period)
+
+    def run(self):
+        self.last_run = time.time()
+        if self.days or self.keep_count:
+            self.purge()
+        if not self.compacted:
+            self.compact()
+        if self.vacuum_period and time.time() - self.last_vacuum >= self.vacuum_period:
+            self.vacuum()
+            self.last_vacuum = time.time()
+
+    def purge(self):
+        created_before = time.time() - timedelta(days=self.days).total_seconds() if self.days else None
+        archive = ArchiveWriter(self.archive_path, self.segment_size) if self.archive_path else None
+        purged = 0
+        try:
+            while True:
+                rows, code = self.scan_manager.db_expired_records(created_before, self.keep_count, self.batch)
+                if code != 0:
+                    self.log.error(f'unable to read expired scans: {rows}')
+                    break
+                if not rows:
+                    break
+                if archive is not None:
+                    for row in rows:
+                        archive.write(self.archive_line(row))
+                    archive.flush()
+                guids = [row[0] for row in rows]
+                response, code = self.scan_manager.db_delete_records(guids)
+                if code != 0:
+                    self.log.error(f'unable to delete expired scans: {response}')
+                    break
+                self.scan_manager.execute_request(
+                    f'DELETE FROM callbacks WHERE guid IN ({", ".join("?" * len(guids))})', tuple(guids))
+                for guid in guids:
+                    self.scan_manager.scan_sessions_map.discard(guid)
+                purged += len(guids)
+                # short batches with pauses: scan writes are not delayed by purge
+                time.sleep(self.BATCH_PAUSE)
+        finally:
+            if archive is not None:
+                archive.close()
+                self.segments += archive.segments
+        self.purged += purged
+        self.archived += purged if archive is not None else 0
+        if purged:
+            self.log.info(f'{purged} expired scans removed' + (f', archived to {self.archive_path}' if archive else ''))
+            self.scan_manager.execute_request('PRAGMA incremental_vacuum')
+
+    @staticmethod
+    def archive_line(row):
+        scan_session = service_types.upload_dict(service_types.scan_session_scheme, row)
+        scan_session['scan_summary']['verdict'] = row[-1]
+        return compact_json(scan_session)
+
+    def compact(self):
+        while True:
+            count, code = self.scan_manager.db_compact_records(self.batch)
+            if code != 0:
+                self.log.error(f'unable to compact scans: {count}')
+                return
+            if count == 0:
+                self.compacted = True
+                return
+            self.log.debug(f'{count} scans re-written without indents')
+            time.sleep(self.BATCH_PAUSE)
+
+    def switch_auto_vacuum(self):
+        rows, code = self.scan_manager.execute_request('PRAGMA auto_vacuum')
+        if code != 0 or rows[0][0] == AUTO_VACUUM_INCREMENTAL:
+            return
+        # mode is switched by full VACUUM once, later only free pages are released
+        self.log.info('switch scans database to incremental auto vacuum, full vacuum is running...')
+        self.scan_manager.execute_exclusive(f'PRAGMA auto_vacuum = {AUTO_VACUUM_INCREMENTAL}')
+        response, code = self.scan_manager.execute_exclusive('VACUUM')
+        if code != 0:
+            self.log.error(f'unable to vacuum scans database: {response}')
+
+    def vacuum(self):
+        # no-op until database is switched to incremental auto vacuum (vacuumfull): free pages are reused by SQLite
+        self.scan_manager.execute_request('PRAGMA incremental_vacuum')
+        self.scan_manager.execute_exclusive('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.log.debug(f'scans database vacuumed, size {self.database_size()} bytes')
+
+    def database_size(self):
+        path = Path(self.scan_manager.path)
+        return sum(item.stat().st_size for item in (path, Path(f'{path}-wal')) if item.exists())
+
+    def retention_info(self):
+        return {
+            'days'      : self.days or None,
+            'keep_count': self.keep_count or None,
+            'archive'   : str(self.archive_path) if self.archive_path else None,
+            'purged'    : self.purged,
+            'archived'  : self.archived,
+            'segments'  : self.segments,
+            'last_run'  : service_util.reformat_datetime_object(datetime.fromtimestamp(self.last_run))
+            if self.last_run else None,
+            'size'      : self.database_size() if self.scan_manager and self.scan_manager.path else None
+        }
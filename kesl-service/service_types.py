@@ -36,7 +36,8 @@ def new_scan_session():
             'type'   : None,
             'source' : None,
             'context': {},
-            'items'  : {}
+            'items'  : {},
+            'hashes' : {}
         }
     }
     return scan_session
@@ -1,6 +1,7 @@
 import copy
 import json
 import pathlib
+import validators
 from dateutil import parser
 from datetime import datetime
 from service_types import SecureString
@@ -61,6 +62,22 @@ def reformat_datetime_string(date_string):
         return f'datetime error {ex}'
 
 
+def validate_params_urls(scan_params):
+    """
+    destination and custom callback uris of scan params which are not valid urls
+    """
+    bad_data = []
+    if not isinstance(scan_params, dict):
+        return bad_data
+    if key_exists(scan_params, 'destination') and not validators.url(scan_params['destination']):
+        bad_data.append({'destination': scan_params['destination']})
+    for clbk in ('on_detect', 'on_complete'):
+        if key_exists(scan_params, 'custom_callbacks', clbk, 'uri') and \
+                not validators.url(scan_params['custom_callbacks'][clbk]['uri']):
+            bad_data.append({'on detect uri': scan_params['custom_callbacks'][clbk]['uri']})
+    return bad_data
+
+
 def reformat_datetime_object(date_object: datetime):
     return date_object.astimezone().isoformat()
 
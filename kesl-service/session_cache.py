@@ -0,0 +1,83 @@
+import threading
+from collections import OrderedDict
+
+
+class SessionCache:
+    """
+    scan sessions by guid, least recently used completed sessions are dropped above capacity,
+    sessions which are not completed or are pinned by running scan are never dropped
+    """
+
+    TERMINAL_STATUSES = ('completed', )
+
+    def __init__(self, capacity):
+        self.capacity = max(1, int(capacity))
+        self.mutex = threading.RLock()
+        self.sessions = OrderedDict()
+        self.pinned = dict()
+        self.evicted = 0
+
+    def __contains__(self, guid):
+        with self.mutex:
+            return guid in self.sessions
+
+    def __getitem__(self, guid):
+        with self.mutex:
+            self.sessions.move_to_end(guid)
+            return self.sessions[guid]
+
+    def __setitem__(self, guid, scan_session):
+        with self.mutex:
+            self.sessions[guid] = scan_session
+            self.sessions.move_to_end(guid)
+            self.evict()
+
+    def get(self, guid):
+        with self.mutex:
+            return self[guid] if guid in self.sessions else None
+
+    def discard(self, guid):
+        with self.mutex:
+            self.sessions.pop(guid, None)
+
+    def __iter__(self):
+        with self.mutex:
+            return iter(list(self.sessions))
+
+    def __len__(self):
+        with self.mutex:
+            return len(self.sessions)
+
+    def pin(self, guid):
+        with self.mutex:
+            self.pinned[guid] = self.pinned.get(guid, 0) + 1
+
+    def unpin(self, guid):
+        with self.mutex:
+            self.pinned[guid] = self.pinned.get(guid, 1) - 1
+            if self.pinned[guid] <= 0:
+                del self.pinned[guid]
+            self.evict()
+
+    def evictable(self, guid):
+        return guid not in self.pinned and \
+            self.sessions[guid]['scan_summary']['status'] in self.TERMINAL_STATUSES
+
+    def evict(self):
+        with self.mutex:
+            if len(self.sessions) <= self.capacity:
+                return
+            for guid in [guid for guid in self.sessions if self.evictable(guid)]:
+                if len(self.sessions) <= self.capacity:
+                    break
+                del self.sessions[guid]
+                self.evicted += 1
+
+    def cache_info(self):
+        with self.mutex:
+            return {
+                'sessions': len(self.sessions),
+                'active'  : len([guid for guid in self.sessions if not self.evictable(guid)]),
+                'capacity': self.capacity,
+                'evicted' : self.evicted
+            }
@@ -0,0 +1,253 @@
+import os
+import uuid
+import shutil
+import hashlib
+import logging
+import threading
+import service_util
+from pathlib import Path
+from flask import Request
+from configurator import service_config
+from service_types import SpecSingleton
+
+
+class SpoolLimitExceeded(ValueError):
+    pass
+
+
+class SpoolManager(metaclass=SpecSingleton):
+    """
+    small objects go to RAM-backed directory (bounded by total budget), others to the disk directories
+    """
+
+    TIER_RAM  = 'ram'
+    TIER_DISK = 'disk'
+
+    def __init__(self):
+        self.log = logging.getLogger('main.spool')
+        self.mutex = threading.Lock()
+        self.ram_dir = service_config['COMMON']['KRAS4D_SPOOLRAMDIR']
+        self.ram_threshold = int(service_config['COMMON']['KRAS4D_SPOOLRAMTHRESHOLD'] or 0)
+        self.ram_budget = int(service_config['COMMON']['KRAS4D_SPOOLRAMBUDGET'] or 0)
+        self.ram_used = 0
+        self.disk_dirs = [item.strip() for item in str(service_config['COMMON']['KRAS4D_SPOOLDIRS']).split(',')
+                          if item.strip()] if service_config['COMMON']['KRAS4D_SPOOLDIRS'] \
+            else [str(service_config['COMMON']['KRAS4D_TMPPATH'])]
+        # path -> (tier, reserved bytes)
+        self.placements = dict()
+
+    def final_construct(self):
+        for directory in self.disk_dirs:
+            Path(directory).mkdir(parents=True, exist_ok=True)
+        if self.ram_enabled:
+            try:
+                Path(self.ram_dir).mkdir(parents=True, exist_ok=True)
+                # files left by previous run may still belong to queued scans
+                for item in Path(self.ram_dir).iterdir():
+                    if item.is_file():
+                        self.placements[str(item)] = (self.TIER_RAM, item.stat().st_size)
+                        self.ram_used += item.stat().st_size
+            except OSError as ex:
+                self.log.error(f'unable to use RAM spool {self.ram_dir}: {ex}')
+                self.ram_dir = None
+        return '', 0
+
+    @property
+    def ram_enabled(self):
+        return bool(self.ram_dir) and self.ram_budget > 0 and self.ram_threshold > 0
+
+    def reserve_ram(self, size):
+        with self.mutex:
+            if self.ram_used + size > self.ram_budget:
+                return False
+            self.ram_used += size
+            return True
+
+    def disk_directory(self):
+        # most free space first
+        if len(self.disk_dirs) == 1:
+            return self.disk_dirs[0]
+        return max(self.disk_dirs, key=lambda directory: shutil.disk_usage(directory).free)
+
+    def create(self, expected_size=None, suffix=''):
+        if self.ram_enabled and expected_size is not None and expected_size <= self.ram_threshold \
+                and self.reserve_ram(expected_size):
+            spool_file = SpoolFile(self.ram_dir, suffix, self, self.TIER_RAM, expected_size)
+        else:
+            spool_file = SpoolFile(self.disk_directory(), suffix, self, self.TIER_DISK)
+        with self.mutex:
+            self.placements[spool_file.path] = (spool_file.tier, spool_file.reserved)
+        return spool_file
+
+    def extend(self, spool_file, size):
+        # object turned out bigger than announced: above threshold it is spilled to disk
+        if spool_file.reserved + size > self.ram_threshold or not self.reserve_ram(size):
+            return False
+        with self.mutex:
+            self.placements[spool_file.path] = (self.TIER_RAM, spool_file.reserved + size)
+        return True
+
+    def trim(self, spool_file):
+        # reservation made for announced size is cut down to the real one
+        with self.mutex:
+            tier, reserved = self.placements.get(spool_file.path, (None, 0))
+            if tier != self.TIER_RAM or reserved <= spool_file.size:
+                return
+            self.ram_used -= reserved - spool_file.size
+            self.placements[spool_file.path] = (tier, spool_file.size)
+        spool_file.reserved = spool_file.size
+
+    def forget(self, path):
+        with self.mutex:
+            tier, reserved = self.placements.pop(str(path), (None, 0))
+            if tier == self.TIER_RAM:
+                self.ram_used -= reserved
+
+    def spill(self, spool_file):
+        path = SpoolFile.make_path(self.disk_directory(), spool_file.suffix)
+        self.log.debug(f'spill {spool_file.path} ({spool_file.size} bytes) to {path}')
+        shutil.copyfile(spool_file.path, path)
+        self.release(spool_file.path)
+        with self.mutex:
+            self.placements[path] = (self.TIER_DISK, 0)
+        return path
+
+    def release(self, path):
+        service_util.soft_remove(path)
+        self.forget(path)
+
+    def spool_info(self):
+        with self.mutex:
+            ram_files = sum(1 for tier, _ in self.placements.values() if tier == self.TIER_RAM)
+            ram_info = {
+                'directory': self.ram_dir,
+                'threshold': self.ram_threshold,
+                'budget'   : self.ram_budget,
+                'used'     : self.ram_used,
+                'files'    : ram_files
+            } if self.ram_enabled else {'enabled': False}
+        disk_info = []
+        for directory in self.disk_dirs:
+            try:
+                usage = shutil.disk_usage(directory)
+                disk_info.append({'directory': directory, 'total': usage.total, 'free': usage.free,
+                                  'files': sum(1 for _ in os.scandir(directory))})
+            except OSError as ex:
+                disk_info.append({'directory': directory, 'error': str(ex)})
+        return {self.TIER_RAM: ram_info, self.TIER_DISK: disk_info}
+
+
+class SpoolFile:
+
+    def __init__(self, directory, suffix='', manager=None, tier=SpoolManager.TIER_DISK, reserved=0):
+        self.log = logging.getLogger('main.spool')
+        self.suffix = suffix
+        self.path = self.make_path(directory, suffix)
+        self.file = open(self.path, 'wb+')
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.manager = manager
+        self.tier = tier
+        self.reserved = reserved
+
+    @staticmethod
+    def make_path(directory, suffix=''):
+        return str(Path(directory).joinpath(str(uuid.uuid4()) + suffix).absolute())
+
+    @property
+    def name(self):
+        return self.path
+
+    @property
+    def sha256(self):
+        return self.digest.hexdigest()
+
+    def write(self, data):
+        self.size += len(data)
+        if self.tier == SpoolManager.TIER_RAM and self.size > self.reserved:
+            if self.manager.extend(self, self.size - self.reserved):
+                self.reserved = self.size
+            else:
+                self.spill()
+        self.digest.update(data)
+        return self.file.write(data)
+
+    def spill(self):
+        position = self.file.tell()
+        self.file.close()
+        self.path = self.manager.spill(self)
+        self.file = open(self.path, 'rb+')
+        self.file.seek(position)
+        self.tier, self.reserved = SpoolManager.TIER_DISK, 0
+
+    def read(self, *args):
+        return self.file.read(*args)
+
+    def seek(self, *args):
+        return self.file.seek(*args)
+
+    def tell(self):
+        return self.file.tell()
+
+    def flush(self):
+        return self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    def copy_from(self, source, chunk_size=None):
+        chunk_size = int(chunk_size if chunk_size else service_config['COMMON']['KRAS4D_SPOOLCHUNK'])
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            self.write(chunk)
+        return self
+
+    def commit(self):
+        self.close()
+        if self.manager is not None:
+            self.manager.trim(self)
+        return self.path, self.sha256, self.size
+
+    def discard(self):
+        self.close()
+        if self.manager is not None:
+            self.manager.release(self.path)
+        else:
+            service_util.soft_remove(self.path)
+
+
+class SpoolRequest(Request):
+    """
+    multipart parts are written straight to spool files (hashed and counted on the fly)
+    instead of werkzeug in-memory / temporary file buffers
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.spool_files = []
+
+    def create_spool_file(self, suffix='', expected_size=None):
+        # body size is limited by MAX_CONTENT_LENGTH: werkzeug raises RequestEntityTooLarge while reading
+        spool_file = SpoolManager().create(expected_size, suffix)
+        self.spool_files.append(spool_file)
+        return spool_file
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # parts are parsed one by one: previous ones are complete and keep only their real size
+        spool_manager = SpoolManager()
+        for spool_file in self.spool_files:
+            spool_manager.trim(spool_file)
+        # part size is rarely announced: part starts in RAM with threshold-sized reservation (or the whole
+        # request size if it is smaller) and is spilled to disk if it grows above threshold
+        if not content_length:
+            content_length = min(total_content_length, spool_manager.ram_threshold) if total_content_length \
+                else spool_manager.ram_threshold
+        return self.create_spool_file(expected_size=content_length)
+
+    def discard_spool_files(self):
+        for spool_file in self.spool_files:
+            spool_file.discard()
+        self.spool_files.clear()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+#
+# compare podman storage drivers: pull + ContainerScan + rmi time and disk usage per driver
+# run inside the service container while no scans are running, e.g.:
+#   python3 storage_benchmark.py docker.io/library/alpine:latest docker.io/library/python:3.11 --rounds 3
+#
+import os
+import time
+import argparse
+import statistics
+import control  # noqa: F401 (must be imported before configurator users)
+from kesl_control import KESLControl
+from podman_control import PodmanControl, PodmanStorage
+
+
+def timed(func, *args):
+    start = time.monotonic()
+    response, code = func(*args)
+    return response, code, time.monotonic() - start
+
+
+def directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def benchmark_driver(driver, images, rounds, scan):
+    storage = PodmanStorage()
+    response, code = storage.probe(driver)
+    if code != 0:
+        print(f'{driver}: not available ({response})')
+        return None
+    storage.driver = driver
+    storage.update_storage_conf()
+    pm_control, av_control = PodmanControl(), KESLControl()
+    if scan:
+        response, code = av_control.enable_disable_podman(True)
+        if code != 0:
+            print(f'{driver}: unable to point KESL to {storage.root} ({response})')
+            return None
+    timings = {'pull': [], 'scan': [], 'remove': [], 'disk': []}
+    for number in range(rounds):
+        for image in images:
+            host, name = image.split('/', 1)
+            iid, code, elapsed = timed(pm_control.podman_pull, host, name)
+            if code != 0:
+                print(f'{driver}: unable to pull {image} ({iid})')
+                continue
+            timings['pull'].append(elapsed)
+            timings['disk'].append(directory_size(storage.root))
+            if scan:
+                response, code, elapsed = timed(av_control.complete_scan, f'benchmark_{number}', {image: iid},
+                                                'ContainerScan')
+                if code != 0:
+                    print(f'{driver}: unable to scan {image} ({response})')
+                timings['scan'].append(elapsed)
+            response, code, elapsed = timed(pm_control.podman_remove, iid)
+            if code != 0:
+                print(f'{driver}: unable to remove {image} ({response})')
+            timings['remove'].append(elapsed)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='podman storage drivers benchmark')
+    parser.add_argument('images', nargs='+', help='full image names: registry/name:tag')
+    parser.add_argument('--drivers', default=','.join(PodmanStorage.DRIVERS), help='comma separated driver list')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--no-scan', action='store_true', help='measure pull and remove only')
+    args = parser.parse_args()
+    results = dict()
+    for driver in args.drivers.split(','):
+        results[driver] = benchmark_driver(driver.strip(), args.images, args.rounds, not args.no_scan)
+    print(f'{"driver":<16}{"pull, s":>10}{"scan, s":>10}{"remove, s":>11}{"total, s":>10}{"disk, MB":>10}')
+    for driver in results:
+        if not results[driver]:
+            continue
+        average = {key: statistics.mean(results[driver][key]) if results[driver][key] else 0.0
+                   for key in results[driver]}
+        total = average['pull'] + average['scan'] + average['remove']
+        print(f'{driver:<16}{average["pull"]:>10.2f}{average["scan"]:>10.2f}{average["remove"]:>11.2f}'
+              f'{total:>10.2f}{average["disk"] / 1024 / 1024:>10.1f}')
+    # return podman and KESL to the driver the service works with
+    PodmanStorage().final_construct()
+    if not args.no_scan:
+        KESLControl().enable_disable_podman(True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 import time
 import logging
+import threading
 import subprocess
 import multiprocessing
 from product_info import ProductInfo
@@ -22,13 +23,12 @@ class Tasker(metaclass=SpecSingleton):
         # semaphore: restart
         self.restart_semaphore = False
         self.restart_semaphore_mutex = multiprocessing.Lock()
-        # semaphore: scan thread count
-        self.st_count = 0
-        self.st_count_mutex = multiprocessing.Lock()
-        # thread operations
+        # scan pool accounting
+        self.scan_pool = None
+        # thread operations (thread, not process: semaphore and pool state must be shared with scan workers)
         self.stop_thread = False
         self.stop_thread_mutex = multiprocessing.Lock()
-        self.thread_point = multiprocessing.Process(target=self.thread_func)
+        self.thread_point = threading.Thread(target=self.thread_func, name='tasker', daemon=True)
         self.thread_point.start()
 
     def __del__(self):
@@ -97,17 +97,11 @@ class Tasker(metaclass=SpecSingleton):
             return self.restart_semaphore
 
     """
-        scan thread count
+        scan pool accounting
     """
-    def st_inc(self):
-        with self.st_count_mutex:
-            self.st_count += 1
-
-    def st_dec(self):
-        with self.st_count_mutex:
-            self.st_count -= (1 if self.st_count > 0 else 0)
+    def register_scan_pool(self, scan_pool):
+        self.scan_pool = scan_pool
 
     @property
     def scan_thread_count(self):
-        with self.st_count_mutex:
-            return self.st_count
+        return self.scan_pool.active_count if self.scan_pool else 0
@@ -0,0 +1,122 @@
+import json
+import time
+import hashlib
+import logging
+import threading
+import service_util
+
+CREATE_CACHE_REQUEST = '''
+    CREATE TABLE IF NOT EXISTS {}(
+        cache_key    TEXT PRIMARY KEY,
+        object_hash  TEXT,
+        db_release   TEXT,
+        scan_options TEXT,
+        verdict      TEXT,
+        created      REAL,
+        accessed     REAL
+    );
+'''
+
+CREATE_CACHE_INDEX_REQUEST = '''
+    CREATE INDEX IF NOT EXISTS {0}_accessed ON {0}(accessed);
+'''
+
+
+class VerdictCache:
+
+    CACHEABLE_VERDICTS = ('clean', 'infected')
+    EVICT_PERIOD       = 100
+
+    def __init__(self, storage, table, enabled=True, max_size=100000, ttl=604800):
+        self.log = logging.getLogger('main.verdict-cache')
+        self.storage = storage
+        self.table = table
+        self.enabled = enabled
+        self.max_size = int(max_size)
+        self.ttl = int(ttl)
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.stat_mutex = threading.Lock()
+
+    def final_construct(self):
+        if not self.enabled:
+            return 'disabled', 0
+        response, code = self.storage.execute_request(CREATE_CACHE_REQUEST.format(self.table))
+        if code == 0:
+            response, code = self.storage.execute_request(CREATE_CACHE_INDEX_REQUEST.format(self.table))
+        if code != 0:
+            self.log.error(f'unable to create verdict cache {self.table}: {response}')
+            self.enabled = False
+        return response, code
+
+    @staticmethod
+    def make_key(object_hash, db_release, scan_options):
+        return hashlib.sha256(f'{object_hash}|{db_release}|{scan_options}'.encode('utf-8')).hexdigest()
+
+    def usable(self, object_hash, db_release):
+        return self.enabled and object_hash and db_release and db_release != 'Not available'
+
+    def count(self, hit):
+        with self.stat_mutex:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def lookup(self, object_hash, db_release, scan_options):
+        if not self.usable(object_hash, db_release):
+            return None
+        cache_key = self.make_key(object_hash, db_release, scan_options)
+        request = f'SELECT verdict FROM {self.table} WHERE cache_key = ? AND created >= ?'
+        rows, code = self.storage.execute_request(request, (cache_key, time.time() - self.ttl))
+        if code != 0 or not rows:
+            self.count(False)
+            return None
+        self.count(True)
+        self.storage.execute_request(f'UPDATE {self.table} SET accessed = ? WHERE cache_key = ?',
+                                     (time.time(), cache_key))
+        response = json.loads(rows[0][0])
+        response['cached'] = True
+        return response
+
+    def store(self, object_hash, db_release, scan_options, response):
+        if not self.usable(object_hash, db_release) or not isinstance(response, dict) \
+                or response.get('verdict') not in self.CACHEABLE_VERDICTS \
+                or response.get('cached') or response.get('interrupted'):
+            return
+        verdict = {key: response[key] for key in response if key not in ('started', 'stopped', 'error')}
+        request = f'''
+            INSERT OR REPLACE INTO {self.table}(cache_key, object_hash, db_release, scan_options,
+            verdict, created, accessed) VALUES (?, ?, ?, ?, ?, ?, ?)
+        '''
+        now = time.time()
+        self.storage.execute_request(request, (
+            self.make_key(object_hash, db_release, scan_options), object_hash, db_release, scan_options,
+            json.dumps(verdict, default=service_util.json_default_decode), now, now))
+        with self.stat_mutex:
+            self.stores += 1
+            need_evict = self.stores % self.EVICT_PERIOD == 0
+        if need_evict:
+            self.evict()
+
+    def evict(self):
+        self.storage.execute_request(f'DELETE FROM {self.table} WHERE created < ?', (time.time() - self.ttl,))
+        self.storage.execute_request(f'''
+            DELETE FROM {self.table} WHERE cache_key IN
+            (SELECT cache_key FROM {self.table} ORDER BY accessed DESC LIMIT -1 OFFSET ?)
+        ''', (self.max_size,))
+
+    def cache_info(self):
+        if not self.enabled:
+            return {'enabled': False}
+        rows, code = self.storage.execute_request(f'SELECT COUNT(*) FROM {self.table}')
+        with self.stat_mutex:
+            requests_count = self.hits + self.misses
+            return {
+                'enabled' : True,
+                'entries' : rows[0][0] if code == 0 else None,
+                'hits'    : self.hits,
+                'misses'  : self.misses,
+                'hit_rate': round(self.hits / requests_count, 4) if requests_count else 0.0
+            }